@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""调仓回测内核 - 持仓/估值/止损都在数组上做, 装了numba就编译执行"""
+import numpy as np
+
+from _data import top_n
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """没有numba时原样返回函数 (纯Python执行, 结果相同)"""
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+def pad_picks(sel, n):
+    """每个调仓日的候选股票下标 -> [调仓日, n] 矩阵, 不足n只的用-1补齐"""
+    m = np.full((len(sel), n), -1, np.int64)
+    for i, t in enumerate(sel):
+        m[i, :len(t)] = t
+    return m
+
+
+@njit(cache=True)
+def holdings_value(shares, px):
+    """持仓市值: 一次向量乘加, 停牌(NaN)按0计"""
+    return np.sum(shares * np.where(np.isnan(px), 0.0, px))
+
+
+@njit(cache=True)
+def run_year(close_mat, signal, rows, picks, end_row, p, s, init, tp=np.inf):
+    """单年回测, 返回年末总资产
+
+    close_mat: [日期, 股票] 收盘价, 停牌为NaN
+    signal: 每个交易日的择时信号, 0 = 清仓
+    rows: 当年调仓日的行号; picks: 对应的候选股票 (pad_picks)
+    p: 仓位, s: 止损线, tp: 止盈线 (默认不止盈), 持仓按候选等权 tot * p / 候选数
+    """
+    T = close_mat.shape[1]
+    cash = init
+    # 持仓按股票下标存成两个定长数组 (几百只股票只占几KB, 常驻L1)
+    shares = np.zeros(T, np.int32)
+    cost = np.zeros(T, np.float32)
+    in_cand = np.zeros(T, np.bool_)
+
+    for i in range(len(rows)):
+        px = close_mat[rows[i]]
+        off = signal[rows[i]] == 0
+        k = 0
+        while k < picks.shape[1] and picks[i, k] >= 0:
+            k += 1
+        in_cand[:] = False
+        for c in range(k):
+            in_cand[picks[i, c]] = True
+
+        # 一次遍历持仓: 估值 + 择时清仓 / 调出候选 / 止损止盈
+        # 新买入的成本就是现价, 不会触发止损止盈, 所以可以挪到买入之前判断;
+        # 被止损止盈的候选从 in_cand 里去掉, 当天不再买回
+        hv = 0.0
+        sold = 0.0
+        for j in range(T):
+            if shares[j] == 0:
+                continue
+            if np.isnan(px[j]):
+                if off:
+                    shares[j] = 0  # 清仓时停牌股按0处理
+                continue
+            v = shares[j] * px[j]
+            hv += v
+            if off or (k > 0 and (not in_cand[j] or px[j] - cost[j] < -s * cost[j] or px[j] - cost[j] > tp * cost[j])):
+                sold += v
+                shares[j] = 0
+                in_cand[j] = False
+        tot = cash + hv
+        cash += sold
+        if off or k == 0:
+            continue
+
+        tgt = tot * p / k
+        for c in range(k):
+            j = picks[i, c]
+            if shares[j] == 0 and in_cand[j]:
+                sh = int(tgt / px[j])
+                if sh > 0:
+                    shares[j] = sh
+                    cost[j] = px[j]
+                    cash -= sh * px[j]
+
+    # 年末
+    return cash + holdings_value(shares, close_mat[end_row])
+
+
+# run_rebal 交易记录里的动作编号
+ACTIONS = ('BUY', 'SELL', 'STOP_LOSS', 'SELL_ALL')
+
+
+@njit(cache=True)
+def _trade(log, n, row, action, j, sh, px, cost):
+    """记一笔交易 (环形缓冲, 只留最近 len(log) 笔), 返回累计笔数"""
+    if len(log):
+        t = log[n % len(log)]
+        t[0], t[1], t[2], t[3], t[4], t[5] = row, action, j, sh, px, cost
+    return n + 1
+
+
+@njit(cache=True)
+def _run_rebal(close, ok, signal, rows, picks, end_row, p, s, init, mult, rolling, deduct, log, curve):
+    T = close.shape[1]
+    cash = init
+    # 持仓按买入先后存 (卖出后保持原顺序), 与按dict逐只处理的顺序和累加顺序一致
+    hid = np.empty(T, np.int64)
+    hsh = np.empty(T, np.int64)
+    hpx = np.empty(T)
+    held = np.zeros(T, np.bool_)
+    in_cand = np.zeros(T, np.bool_)
+    m = 0
+    n_tr = 0
+
+    for i in range(len(rows)):
+        r = rows[i]
+        px = close[r]
+        okr = ok[r]
+
+        if signal[r] == 0:  # 择时清仓, 停牌股按0处理
+            for a in range(m):
+                j = hid[a]
+                if not np.isnan(px[j]):
+                    cash += hsh[a] * px[j]
+                    n_tr = _trade(log, n_tr, r, 3, j, hsh[a], px[j], hpx[a])
+                held[j] = False
+            m = 0
+            continue
+
+        # 调仓前权益只在 rolling 时用到, 清仓日和按init定仓位时不再逐只估值
+        base = init
+        if rolling:
+            hv = 0.0
+            for a in range(m):
+                if not np.isnan(px[hid[a]]):
+                    hv += hsh[a] * px[hid[a]]
+            base = cash + hv
+
+        k = 0
+        while k < picks.shape[1] and picks[i, k] >= 0:
+            k += 1
+        in_cand[:] = False
+        for c in range(k):
+            in_cand[picks[i, c]] = True
+        tgt = base * (p * mult[r]) / k if k > 0 else 0.0
+
+        # 调出候选 (当天不ok的持仓不动)
+        w = 0
+        for a in range(m):
+            j = hid[a]
+            if okr[j] and not in_cand[j]:
+                cash += hsh[a] * px[j]
+                n_tr = _trade(log, n_tr, r, 1, j, hsh[a], px[j], hpx[a])
+                held[j] = False
+            else:
+                hid[w], hsh[w], hpx[w] = j, hsh[a], hpx[a]
+                w += 1
+        m = w
+
+        # 止损
+        w = 0
+        for a in range(m):
+            j = hid[a]
+            if okr[j] and (px[j] - hpx[a]) / hpx[a] < -s:
+                cash += hsh[a] * px[j]
+                n_tr = _trade(log, n_tr, r, 2, j, hsh[a], px[j], hpx[a])
+                held[j] = False
+            else:
+                hid[w], hsh[w], hpx[w] = j, hsh[a], hpx[a]
+                w += 1
+        m = w
+
+        # 买入
+        for c in range(k):
+            j = picks[i, c]
+            if held[j]:
+                continue
+            if deduct and cash < tgt:
+                break
+            sh = int(tgt / px[j])
+            if sh > 0:
+                if deduct:
+                    cash -= sh * px[j]
+                hid[m], hsh[m], hpx[m] = j, sh, px[j]
+                m += 1
+                held[j] = True
+                n_tr = _trade(log, n_tr, r, 0, j, sh, px[j], px[j])
+
+        if len(curve):
+            hv = 0.0
+            for a in range(m):
+                if okr[hid[a]]:
+                    hv += hsh[a] * px[hid[a]]
+            curve[i] = cash + hv
+
+    fv = cash
+    pe = close[end_row]
+    for a in range(m):
+        if not np.isnan(pe[hid[a]]):
+            fv += hsh[a] * pe[hid[a]]
+    return fv, n_tr
+
+
+def run_rebal(close, ok, rows, picks, end_row, p, s, signal=None, mult=None, init=1000000.0,
+              rolling=False, deduct=True, keep=0, curve=False):
+    """v3/v4/v6~v9 的单年调仓回测, 持仓按买入先后处理, 结果与逐只循环一致
+
+    ok: [日期, 股票] 当天通过选股过滤; 持仓只有当天ok才会被调出候选或止损
+    signal: 择时, 0 = 清仓; mult: 每个交易日的仓位系数, 目标仓位 = 资金 * p * mult / 候选数
+    rolling: 资金按调仓前的当前权益算 (否则按init); deduct: 买入扣现金, 现金不够目标仓位时停止买入
+    keep: 保留最近几笔交易; curve: 记录每个调仓日调仓后的权益 (只计当天ok的持仓)
+    返回 (年末总资产, 交易笔数, 最近keep笔交易 [行号, 动作(ACTIONS), 股票, 股数, 价格, 成本价], 权益序列)
+    """
+    signal = np.ones(len(close), np.int8) if signal is None else signal
+    mult = np.ones(len(close)) if mult is None else mult
+    log = np.zeros((keep, 6))
+    eq = np.zeros(len(rows) if curve else 0)
+    fv, n_tr = _run_rebal(close, ok, signal, np.asarray(rows, np.int64), picks, end_row,
+                          p, s, float(init), mult, rolling, deduct, log, eq)
+    # 环形缓冲转回时间顺序
+    log = np.roll(log, -(n_tr % keep), axis=0) if keep and n_tr > keep else log[:n_tr]
+    return fv, n_tr, log, eq
+
+
+def rebal_rows(dates, years, step=None, min_days=0):
+    """每年的调仓日行号和最后一个交易日行号 {年: (调仓行号, 年末行号)}, 回测开始前算一次
+
+    dates: 升序日期轴 (YYYYMMDD); step=None 每月第一个交易日调仓, 否则从年初起每step个交易日一次;
+    交易日不足min_days的年份跳过
+    """
+    ds = np.array([str(d) for d in dates])
+    out = {}
+    for y in years:
+        # 日期轴有序, 每年的行号区间二分查找, 不逐个比较前缀
+        rows = np.arange(*np.searchsorted(ds, [str(y), str(int(y) + 1)]))
+        if len(rows) == 0 or len(rows) < min_days:
+            continue
+        if step is None:
+            ym = np.array([d[:6] for d in ds[rows]])
+            out[y] = rows[np.r_[True, ym[1:] != ym[:-1]]], rows[-1]
+        else:
+            out[y] = rows[::step], rows[-1]
+    return out
+
+
+def schedule_picks(score, schedule, n):
+    """rebal_rows 每年调仓日的候选 {年: pad_picks}, 网格开始前按最大持仓数n选一次
+
+    与 rebal_plan 一样, 持仓更少的参数直接取前几列。
+    """
+    return {y: pad_picks([top_n(score[r], n) for r in reb], n) for y, (reb, _) in schedule.items()}
+
+
+def year_bounds(dates, years):
+    """每年在日期轴 (int YYYYMMDD, 升序) 上的行号区间 [lo, hi), 二分查找定位"""
+    return {y: np.searchsorted(dates, [int(y) * 10000, (int(y) + 1) * 10000]) for y in years}
+
+
+def rebal_plan(score, bounds, steps, n):
+    """每种调仓间隔 -> (每年调仓日行号, 每年候选 pad_picks), 网格开始前算一次
+
+    候选按最大持仓数n选好, 从高到低排列, 持仓更少时直接取前几列 (与单独选前k只结果相同)。
+    """
+    plan = {}
+    for step in set(steps):
+        rows = {y: np.arange(lo, hi, step) for y, (lo, hi) in bounds.items()}
+        plan[step] = rows, {y: pad_picks([top_n(score[t], n) for t in r], n) for y, r in rows.items()}
+    return plan
+
+
+def run_years(close_mat, signal, bounds, rebal, picks, p, s, init=1000000.0, min_days=0, tp=np.inf):
+    """逐年回测 (每年从init重新开始), 返回 [{'year', 'return'}]; 交易日不足min_days的年份跳过"""
+    res = []
+    for y, (lo, hi) in bounds.items():
+        if hi - lo < min_days:
+            continue
+        fv = run_year(close_mat, signal, rebal[y], picks[y], hi - 1, p, s, init, tp)
+        res.append({'year': y, 'return': (fv - init) / init})
+    return res
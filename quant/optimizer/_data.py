@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""优化器公共数据加载 - 同一进程内多个版本共用一次SQL查询结果"""
+import hashlib
+import multiprocessing as mp
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+DB = '/root/.openclaw/workspace/data/historical/historical.db'
+CACHE = os.path.join(os.path.dirname(DB), 'cache')
+
+
+def _universe_sql(table, min_days, limit):
+    """股票池子查询: 按交易天数过滤 + 数量上限"""
+    sql = f"SELECT ts_code FROM {table} GROUP BY ts_code"
+    if min_days:
+        sql += f" HAVING COUNT(*) > {int(min_days)}"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return sql
+
+
+def connect():
+    """只读查询用的连接: 开mmap和64MB页缓存, 临时排序/分组放内存"""
+    conn = sqlite3.connect(DB)
+    conn.executescript("PRAGMA mmap_size=268435456; PRAGMA cache_size=-65536; PRAGMA temp_store=MEMORY;")
+    return conn
+
+
+def db_stamp():
+    """库文件 (大小, 修改时间), 库一更新就变"""
+    st = os.stat(DB)
+    return st.st_size, st.st_mtime_ns
+
+
+def disk_cache(name, stamp, build):
+    """磁盘缓存: CACHE/{name}.pkl 里存 (stamp, 结果)
+
+    stamp 对得上直接返回缓存, 对不上 (库更新了/代码版本变了) 调 build() 重算并覆盖同一个文件,
+    每个 name 只留一份, 不会随库的每日更新越积越多。
+    """
+    path = os.path.join(CACHE, f'{name}.pkl')
+    if os.path.exists(path):
+        old, value = pd.read_pickle(path)
+        if old == stamp:
+            return value
+    value = build()
+    os.makedirs(CACHE, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    pd.to_pickle((stamp, value), tmp)
+    os.replace(tmp, path)
+    return value
+
+
+def query(sql, params=()):
+    """不带缓存的只读查询"""
+    conn = connect()
+    try:
+        return pd.read_sql(sql, conn, params=list(params))
+    finally:
+        conn.close()
+
+
+def read_sql(sql, params=()):
+    """带磁盘缓存的查询
+
+    结果按 (SQL, 参数) 存成pickle, 里面记着库文件大小/修改时间, 库没更新时后续运行直接读缓存,
+    跳过SQLite逐行解析和类型推断; 库更新后重查并覆盖原文件。
+    """
+    key = hashlib.md5(f"{sql}|{params}".encode()).hexdigest()[:16]
+    return disk_cache(f'sql_{key}', db_stamp(), lambda: query(sql, params))
+
+
+def load_universe(sql):
+    """股票池: 池子查询单独跑, 返回代码元组
+
+    主查询改成 ts_code IN (?, ?, ...) 绑定参数, 走 (ts_code, trade_date) 主键,
+    不再对每一行去探测一次子查询结果。
+    """
+    return tuple(read_sql(sql)['ts_code'])
+
+
+def marks(codes):
+    """IN 子句的占位符 ?, ?, ..."""
+    return ', '.join('?' * len(codes))
+
+
+def compact(df):
+    """ts_code 转 category, trade_date (YYYYMMDD) 转 int32, 等值比较和分组都走整数路径;
+    行情列 close/volume/amount 转 float32 (价格只有4位有效数字, 内存减半)"""
+    df['ts_code'] = df['ts_code'].astype('category')
+    df['trade_date'] = df['trade_date'].astype('int32')
+    for c in ('close', 'volume', 'amount'):
+        if c in df:
+            df[c] = df[c].astype('float32')
+    return df
+
+
+@lru_cache(maxsize=4)
+def _read_daily(start, end, min_days, limit, cols, universe):
+    codes = load_universe(_universe_sql(universe, min_days, limit))
+    sql = f"""
+        SELECT ts_code, trade_date, {', '.join(cols)} FROM daily_price
+        WHERE ts_code IN ({marks(codes)}) AND trade_date BETWEEN ? AND ?
+    """
+    return read_sql(sql, (*codes, start, end))
+
+
+@lru_cache(maxsize=4)
+def _read_factors(start, end, cols):
+    sql = f"""
+        SELECT ts_code, trade_date, {', '.join(cols)} FROM stock_factors
+        WHERE trade_date BETWEEN '{start}' AND '{end}'
+    """
+    return read_sql(sql)
+
+
+def load_daily(start, end, min_days=200, limit=None, cols=('close', 'volume'), universe='daily_price'):
+    """日线行情 (daily_price)
+
+    universe: 股票池来源表, min_days/limit 对应 HAVING COUNT(*) > min_days LIMIT limit
+    返回副本, 调用方可以直接在上面加因子列而不污染缓存
+    """
+    return _read_daily(start, end, min_days, limit, tuple(cols), universe).copy()
+
+
+def load_factors(start, end, cols):
+    """预计算因子 (stock_factors), 返回副本"""
+    return _read_factors(start, end, tuple(cols)).copy()
+
+
+def snapshot(day, col, size):
+    """单日截面 -> 按股票编号(tid)对齐的向量, 当日缺失的股票为NaN"""
+    v = np.full(size, np.nan)
+    v[day['tid'].to_numpy()] = day[col].to_numpy()
+    return v
+
+
+def add_axes(df):
+    """给长表加 row(日期下标) / tid(股票下标) 两列, 返回排好序的日期轴和股票轴"""
+    df['row'], dates = pd.factorize(df['trade_date'], sort=True)
+    df['tid'], codes = pd.factorize(df['ts_code'], sort=True)
+    return np.asarray(dates), np.asarray(codes)
+
+
+def panel(df, col, shape, dtype=float):
+    """长表某列 -> [日期, 股票] 宽矩阵 (需先 add_axes), 缺失为NaN"""
+    m = np.full(shape, np.nan, dtype)
+    m[df['row'].to_numpy(), df['tid'].to_numpy()] = df[col].to_numpy()
+    return m
+
+
+def group_pct_change(df, col, periods):
+    """按股票分组的periods日涨跌幅
+
+    等价 df.groupby('ts_code')[col].pct_change(periods), 组内沿用df原有行序, 前periods行或
+    任一端为NaN时为NaN。按组排好后和periods行之前比, 同组才算, 一次向量运算算完所有股票。
+    """
+    g = pd.factorize(df['ts_code'])[0]
+    order = np.argsort(g, kind='stable')
+    g = g[order]
+    x = df[col].to_numpy(float)[order]
+    r = np.full(len(x), np.nan)
+    same = g[periods:] == g[:-periods]
+    r[periods:][same] = x[periods:][same] / x[:-periods][same] - 1
+
+    out = np.empty(len(x))
+    out[order] = r
+    return out
+
+
+def group_rolling(df, col, window, stat='mean'):
+    """按股票分组的滚动均值/标准差
+
+    等价 df.groupby('ts_code')[col].rolling(window).mean() / .std(), 组内沿用df原有行序,
+    窗口内有NaN或不足window行时为NaN。组内先去均值再做累加和, 一次向量运算算完所有股票。
+    """
+    g = pd.factorize(df['ts_code'])[0]
+    order = np.argsort(g, kind='stable')
+    g = g[order]
+    x = df[col].to_numpy(float)[order]
+    ok = ~np.isnan(x)
+    mu = np.bincount(g, np.where(ok, x, 0)) / np.maximum(np.bincount(g, ok), 1)
+    x = np.where(ok, x - mu[g], 0.0)
+
+    i = np.arange(len(x))
+    lo = np.maximum(i - window + 1, 0)
+    c = np.concatenate(([0], np.cumsum(ok)))
+    full = (i - window + 1 >= np.searchsorted(g, g)) & (c[i + 1] - c[lo] == window)
+    c = np.concatenate(([0.0], np.cumsum(x)))
+    s1 = c[i + 1] - c[lo]
+    if stat == 'mean':
+        r = s1 / window + mu[g]
+    else:
+        c = np.concatenate(([0.0], np.cumsum(x * x)))
+        r = np.sqrt(np.maximum((c[i + 1] - c[lo] - s1 * s1 / window) / (window - 1), 0))
+
+    out = np.full(len(x), np.nan)
+    out[order[full]] = r[full]
+    return out
+
+
+def rank_pct(a):
+    """百分位排名, 等价 Series.rank(pct=True): 并列取平均名次, NaN保持NaN"""
+    a = np.asarray(a, float)
+    out = np.full(len(a), np.nan)
+    ok = ~np.isnan(a)
+    v = a[ok]
+    if not len(v):
+        return out
+    order = np.argsort(v, kind='stable')
+    s = v[order]
+    new = np.r_[True, s[1:] != s[:-1]]
+    starts = np.flatnonzero(new)
+    ends = np.r_[starts[1:], len(s)]
+    r = np.empty(len(s))
+    r[order] = ((starts + 1 + ends) / 2.0)[np.cumsum(new) - 1]
+    out[ok] = r / len(v)
+    return out
+
+
+def cs_rank(m):
+    """[日期, 股票] 矩阵逐行 (每个交易日截面) 的百分位排名, 等价逐行 rank(pct=True)
+
+    整个矩阵只做一次按行argsort; 并列取平均名次, NaN保持NaN且不计入分母。
+    """
+    m = np.asarray(m, float)
+    ok = ~np.isnan(m)
+    order = np.argsort(np.where(ok, m, np.inf), axis=1, kind='stable')
+    s = np.take_along_axis(m, order, axis=1)
+    i = np.broadcast_to(np.arange(m.shape[1]), m.shape)
+    # 排好序后每个值所在并列段的首尾位置, 名次取两者平均
+    head = np.ones(m.shape, bool)
+    head[:, 1:] = s[:, 1:] != s[:, :-1]
+    tail = np.ones(m.shape, bool)
+    tail[:, :-1] = head[:, 1:]
+    lo = np.maximum.accumulate(np.where(head, i, 0), axis=1)
+    hi = np.minimum.accumulate(np.where(tail, i, m.shape[1] - 1)[:, ::-1], axis=1)[:, ::-1]
+    out = np.empty(m.shape)
+    np.put_along_axis(out, order, (lo + hi) / 2.0 + 1, axis=1)
+    out /= np.maximum(ok.sum(axis=1, keepdims=True), 1)
+    out[~ok] = np.nan
+    return out
+
+
+def top_n(score, n):
+    """得分最高的n个位置, 从高到低
+
+    与 nlargest(n) 同样的顺序 (同分取靠前的), NaN不入选。先用 np.partition 找第n大的值做门槛,
+    只对入选的n个排序, 不对整列排序。
+    """
+    score = np.asarray(score, float)
+    ok = np.flatnonzero(~np.isnan(score))
+    k = min(n, len(ok))
+    if k == 0:
+        return ok[:0]
+    v = score[ok]
+    t = np.partition(v, len(v) - k)[len(v) - k]
+    sel = np.flatnonzero(v > t)
+    sel = np.sort(np.concatenate((sel, np.flatnonzero(v == t)[:k - len(sel)])))
+    return ok[sel[np.argsort(-v[sel], kind='stable')]]
+
+
+def grid_map(fn, grid):
+    """参数网格并行回测, 结果按网格顺序逐个产出 (前面的算完就能先处理, 不必等全部跑完)
+
+    fn 必须是脚本顶层函数; 子进程用fork启动, 直接继承已经算好的行情和因子,
+    不用逐个任务pickle大表。单核时退化为串行。
+    """
+    grid = list(grid)
+    workers = min(os.cpu_count() or 1, len(grid))
+    if workers <= 1:
+        yield from (fn(*g) for g in grid)
+        return
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context('fork')) as ex:
+        yield from ex.map(fn, *zip(*grid), chunksize=max(1, len(grid) // (workers * 4)))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""v3~v24 共用的因子库 - 因子按名字统一计算, 结果是 [日期, 股票] 对齐的float32矩阵, 进程内/磁盘两级缓存"""
+import hashlib
+import json
+import re
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from _data import (db_stamp, disk_cache, query, load_universe, load_daily, marks, compact, add_axes, panel,
+                   group_rolling, group_pct_change, cs_rank)
+
+# 因子算法版本: 改了 _factor / _ROLL 的计算就加1, 旧的磁盘缓存自动作废
+FACTOR_VERSION = 1
+
+# 滚动类因子: 前缀 -> (源列, 统计量), 窗口长度写在名字末尾, 如 ma20 / vol_ma5
+_ROLL = {
+    'ma': ('close', 'mean'),
+    'std': ('close', 'std'),        # 收盘价标准差
+    'vol': ('ret1', 'std'),         # 日收益率标准差
+    'vol_ma': ('volume', 'mean'),
+    'amount_ma': ('amount', 'mean'),
+}
+
+
+def _factor(df, name):
+    """在按 (股票, 日期) 排好序的长表上算因子, 已算过的列直接复用
+
+    retK: K日涨幅; ma/std/vol/vol_ma/amount_maK: 见 _ROLL; money_flowK: 成交额 / K日均额;
+    rel_strength: ret20 减当日截面中位数; f.xxx: stock_factors 表里预计算的列
+    """
+    if name in df:
+        return df[name]
+    base, k = re.fullmatch(r'(\D+?)(\d*)', name).groups()
+    if base == 'ret':
+        df[name] = group_pct_change(df, 'close', int(k))
+    elif base in _ROLL:
+        col, stat = _ROLL[base]
+        _factor(df, col)
+        df[name] = group_rolling(df, col, int(k), stat)
+    elif base == 'money_flow':
+        df[name] = df['amount'] / _factor(df, f'amount_ma{k}')
+    elif name == 'rel_strength':
+        r = _factor(df, 'ret20')
+        df[name] = r - r.groupby(df['trade_date']).transform('median')
+    else:
+        raise KeyError(f'未知因子: {name}')
+    return df[name]
+
+
+@lru_cache(maxsize=4)
+def _build(universe_sql, table, start, end, factors):
+    args = {'universe': universe_sql, 'table': table, 'start': start, 'end': end, 'factors': sorted(factors)}
+    key = hashlib.sha1(json.dumps(args, sort_keys=True).encode()).hexdigest()[:12]
+    return disk_cache(f'factors_{key}', (db_stamp(), FACTOR_VERSION),
+                      lambda: _compute(universe_sql, table, start, end, factors))
+
+
+def _compute(universe_sql, table, start, end, factors):
+    pool = load_universe(universe_sql)
+    raw = [f for f in factors if f.startswith('f.')]
+    join = ' LEFT JOIN stock_factors f ON e.ts_code = f.ts_code AND e.trade_date = f.trade_date' if raw else ''
+    # 原始行情不单独落盘, 只缓存算好的因子矩阵一层
+    df = compact(query(f"""
+        SELECT e.ts_code, e.trade_date, e.close, e.volume, e.amount{''.join(', ' + f for f in raw)}
+        FROM {table} e{join}
+        WHERE e.ts_code IN ({marks(pool)}) AND e.trade_date BETWEEN ? AND ?
+    """, (*pool, start, end)))
+    df = df.rename(columns={f[2:]: f for f in raw})
+    # 按 (股票, 日期) 排好一次, 分组计算不必再按组重排
+    df = df.sort_values(['ts_code', 'trade_date'], ignore_index=True)
+    for f in factors:
+        _factor(df, f)
+
+    dates, codes = add_axes(df)
+    shape = (len(dates), len(codes))
+    out = {'dates': dates, 'codes': codes}
+    for f in ('close',) + factors:
+        out[f] = panel(df, f, shape, np.float32)
+    return out
+
+
+def load_or_build(universe_sql, table, start, end, factors):
+    """按股票池/区间/因子名取因子矩阵
+
+    返回 {'dates': 日期轴(int YYYYMMDD), 'codes': 股票轴, 'close' 及各因子: [日期, 股票] float32矩阵},
+    没有数据处为NaN。同一进程内直接复用, 跨进程读磁盘缓存 (库文件更新或 FACTOR_VERSION 变了自动重算,
+    覆盖原缓存文件)。结果共享, 只读。
+    """
+    return _build(universe_sql, table, start, end, tuple(factors))
+
+
+def timing_signal(close, window, slow=None):
+    """大盘择时: 每日收盘价截面中位数 (跳过停牌NaN) 站上其window日均线为1, 否则为0;
+    给了slow时还要求window日均线在slow日均线之上"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # 整行NaN的日期中位数为NaN, 信号记0
+        mkt = np.nanmedian(close, axis=1)
+    ma = pd.Series(mkt).rolling(window).mean().to_numpy()
+    on = mkt > ma
+    if slow:
+        on &= ma > pd.Series(mkt).rolling(slow).mean().to_numpy()
+    return on.astype(np.int8)
+
+
+# 交易满900天的 stock_efinance 股票池 (v21~v24)
+EFINANCE_900 = "SELECT ts_code FROM stock_efinance GROUP BY ts_code HAVING COUNT(*) > 900"
+
+# 由 stock_factors 预计算因子派生的因子: 名字 -> (依赖的因子, 计算)
+_DERIVED = {
+    'mom_trend': (('ret_20', 'ret_60'), lambda f: f('ret_20') > f('ret_60')),  # 趋势确认
+    'break_high': (('price_pos_20',), lambda f: f('price_pos_20') > 0.8),      # 突破新高
+}
+
+
+def load_panel(weights, slow=None, start='20180101', end='20211231'):
+    """v23/v24 共用的预处理: 行情 + stock_factors 因子 -> 综合评分宽表
+
+    weights: {因子: 权重}, 因子按交易日截面排名 (同一天的股票之间比较) 后加权,
+    权重为负表示越低越好, 按 (1 - 排名) * |权重| 计。只保留 ret_20 非空的 (日期, 股票)。
+    择时: 收盘价截面中位数站上20日均线 (给了slow还要求20日线在slow日线之上)。
+    返回 (close_mat float32, score_mat, signal, codes, dates)
+    """
+    need = {'ret_20'}
+    for c in weights:
+        need |= set(_DERIVED[c][0]) if c in _DERIVED else {c}
+    F = load_or_build(EFINANCE_900, 'stock_efinance', start, end, ['f.' + c for c in sorted(need)])
+
+    ok = ~np.isnan(F['f.ret_20'])
+    days = ok.any(axis=1)  # 整天都没有 ret_20 的日期去掉
+    ok = ok[days]
+    f = lambda c: F['f.' + c][days]
+    close_mat = np.where(ok, F['close'][days], np.nan).astype(np.float32)
+
+    score = 0
+    for c, w in weights.items():
+        v = _DERIVED[c][1](f).astype(float) if c in _DERIVED else f(c)
+        r = cs_rank(np.where(ok, v, np.nan))
+        score = score + ((1 - r) * -w if w < 0 else r * w)
+    return close_mat, score, timing_signal(close_mat, 20, slow), F['codes'], F['dates'][days]
+
+
+
+def load_momentum(start, min_rows, ret60=False, accel=False, end='20211231'):
+    """v3/v4/v6/v7 共用的预处理: daily_price 收盘价 -> 20日动量选股宽表
+
+    股票池: daily_price 里总行数超过 min_rows 的股票。选股过滤 ok: 20日涨幅为正且收盘在60日线上,
+    ret60 时还要求60日涨幅非空, accel 时还要求20日涨幅超过60日涨幅 (动量加速)。
+    mom: 过滤后的20日动量, 保持 float64 (float32 会让排名出现并列); 收盘价过滤完再转 float32。
+    择时 signal: 收盘价截面中位数站上其20日均线为1, 否则为0。
+    返回 (close float32, ret20, ok, mom, signal, dates, codes)
+    """
+    # 股票池单独查一次, 主查询按 ts_code IN (?, ...) 走主键, 不再每行探测子查询; 结果有磁盘缓存
+    df = load_daily(start, end, min_rows, cols=('close',))
+    # 按 (股票, 日期) 排好一次, 分组计算不必再按组重排
+    df = df.sort_values(['ts_code', 'trade_date'], ignore_index=True)
+    df['ret20'] = group_pct_change(df, 'close', 20)  # 所有股票一次向量计算, 不逐组分派
+    df['ret60'] = group_pct_change(df, 'close', 60)
+    df['ma60'] = group_rolling(df, 'close', 60)
+
+    # 摊成 [日期, 股票] 宽表: 回测里按 行号/股票下标 直接取值, 不再每次按日期/代码过滤长表
+    dates, codes = add_axes(df)
+    shape = (len(dates), len(codes))
+    close, ret20, r60, ma60 = (panel(df, c, shape) for c in ('close', 'ret20', 'ret60', 'ma60'))
+    ok = ~np.isnan(ret20) & (close > ma60) & (ret20 > 0)
+    if ret60 or accel:
+        ok &= ~np.isnan(r60)
+    if accel:
+        ok &= ret20 > r60
+    mom = np.where(ok, ret20, np.nan)
+    # 截面中位数直接在宽表上按行算, 不再对长表按日期分组
+    return close.astype(np.float32), ret20, ok, mom, timing_signal(close, 20), dates, codes
@@ -144,20 +144,21 @@ def backtest(df, params, idx_dict):
             tgt = tot * p / len(cand)
             
             # 卖出不在候选中的股票
+            cand_set = set(cand['ts_code'])  # 候选代码集合, 成员判断O(1)
             for c in list(holdings.keys()):
-                if c not in cand['ts_code'].values:
+                if c not in cand_set:
                     cd = rd_d[rd_d['ts_code'] == c]
                     if not cd.empty:
                         cash += holdings[c]['s'] * float(cd['close'].iloc[0])
                         del holdings[c]
             
             # 买入新股票
-            for _, r in cand.iterrows():
-                if r['ts_code'] not in holdings:
-                    sh = int(tgt / r['close'])
+            for c, px in cand[['ts_code', 'close']].itertuples(index=False, name=None):
+                if c not in holdings:
+                    sh = int(tgt / px)
                     if sh > 0:
-                        holdings[r['ts_code']] = {'s': sh, 'p': r['close']}
-                        cash -= sh * r['close']
+                        holdings[c] = {'s': sh, 'p': px}
+                        cash -= sh * px
             
             # 止损止盈
             for c in list(holdings.keys()):
@@ -129,19 +129,20 @@ def bt(p, s, n, rebal=10):
             
             tgt = tot * p / len(cand)
             
+            cand_set = set(cand['ts_code'])  # 候选代码集合, 成员判断O(1)
             for c in list(h.keys()):
-                if c not in cand['ts_code'].values:
+                if c not in cand_set:
                     cd = rd_d[rd_d['ts_code']==c]
                     if not cd.empty:
                         cash += h[c]['s'] * float(cd['close'].iloc[0])
                         del h[c]
             
-            for _, r in cand.iterrows():
-                if r['ts_code'] not in h:
-                    sh = int(tgt / r['close'])
+            for c, px in cand[['ts_code', 'close']].itertuples(index=False, name=None):
+                if c not in h:
+                    sh = int(tgt / px)
                     if sh > 0:
-                        h[r['ts_code']] = {'s': sh, 'p': r['close']}
-                        cash -= sh * r['close']
+                        h[c] = {'s': sh, 'p': px}
+                        cash -= sh * px
             
             for c in list(h.keys()):
                 cd = rd_d[rd_d['ts_code']==c]
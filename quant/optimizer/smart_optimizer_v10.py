@@ -82,19 +82,19 @@ def bt(p, n):
             target_per_stock = target_val / len(cand)
             
             # 卖出不在候选的
+            cand_set = set(cand['ts_code'])  # 候选代码集合, 成员判断O(1)
             for code in list(holdings.keys()):
-                if code not in cand['ts_code'].values:
+                if code not in cand_set:
                     prc = rd_data[rd_data['ts_code'] == code]
                     if not prc.empty:
                         cash += holdings[code]['shares'] * float(prc['close'].iloc[0])
                         del holdings[code]
             
             # 买入
-            for _, row in cand.iterrows():
-                code = row['ts_code']
+            for code, price in cand[['ts_code', 'close']].itertuples(index=False, name=None):
                 if code in holdings:
                     continue
-                price = float(row['close'])
+                price = float(price)
                 shares = int(target_per_stock / price)
                 if shares > 0:
                     holdings[code] = {'shares': shares, 'cost': price}
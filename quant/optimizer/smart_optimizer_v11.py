@@ -72,20 +72,21 @@ def bt(p, s, n):
             tgt = total * p / len(cand)
             
             # 卖出
+            cand_set = set(cand['ts_code'])  # 候选代码集合, 成员判断O(1)
             for code in list(holdings.keys()):
-                if code not in cand['ts_code'].values:
+                if code not in cand_set:
                     prc = rd_data[rd_data['ts_code'] == code]
                     if not prc.empty:
                         cash += holdings[code]['shares'] * float(prc['close'].iloc[0])
                         del holdings[code]
             
             # 买入
-            for _, row in cand.iterrows():
-                if row['ts_code'] in holdings: continue
-                price = float(row['close'])
+            for code, price in cand[['ts_code', 'close']].itertuples(index=False, name=None):
+                if code in holdings: continue
+                price = float(price)
                 shares = int(tgt / price)
                 if shares > 0:
-                    holdings[row['ts_code']] = {'shares': shares, 'cost': price}
+                    holdings[code] = {'shares': shares, 'cost': price}
                     cash -= shares * price
             
             # 止损
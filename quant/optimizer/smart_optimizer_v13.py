@@ -72,20 +72,21 @@ def bt(p, s, n, strict):
             tgt = total * p / len(cand)
             
             # 卖出
+            cand_set = set(cand['ts_code'])  # 候选代码集合, 成员判断O(1)
             for c in list(holdings.keys()):
-                if c not in cand['ts_code'].values:
+                if c not in cand_set:
                     prc = rd_data[rd_data['ts_code']==c]
                     if not prc.empty:
                         cash += holdings[c]['shares'] * float(prc['close'].iloc[0])
                         del holdings[c]
             
             # 买入
-            for _, r in cand.iterrows():
-                if r['ts_code'] not in holdings:
-                    sh = int(tgt / r['close'])
+            for c, px in cand[['ts_code', 'close']].itertuples(index=False, name=None):
+                if c not in holdings:
+                    sh = int(tgt / px)
                     if sh > 0:
-                        holdings[r['ts_code']] = {'shares': sh, 'cost': r['close']}
-                        cash -= sh * r['close']
+                        holdings[c] = {'shares': sh, 'cost': px}
+                        cash -= sh * px
             
             # 止损
             for c in list(holdings.keys()):
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 """智能优化器 v14 - VQM+AlphaBeta模型"""
-import sqlite3, pandas as pd, numpy as np
+import pandas as pd, numpy as np
 from datetime import datetime
+from _data import load_daily, snapshot
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 
 print("="*50)
@@ -11,11 +11,7 @@ print("v14 VQM+AlphaBeta模型")
 print("="*50)
 
 # 取数据
-df = pd.read_sql("""
-    SELECT ts_code, trade_date, close, volume FROM daily_price 
-    WHERE trade_date BETWEEN '20180101' AND '20211231'
-    AND ts_code IN (SELECT ts_code FROM daily_price GROUP BY ts_code HAVING COUNT(*) > 200 LIMIT 300)
-""", sqlite3.connect(DB))
+df = load_daily('20180101', '20211231', min_days=200, limit=300)
 
 # 计算VQM指标
 print("计算VQM指标...")
@@ -44,7 +40,11 @@ idx_dict = dict(zip(idx['trade_date'], idx['trend']))
 # 计算Alpha（相对于大盘的超额收益）
 idx['alpha'] = 0  # 先设为0，后续用持仓相对于大盘计算
 
-print(f"股票: {df['ts_code'].nunique()}")
+# 股票编号: 持仓用 tid 下标的平行数组表示
+df['tid'], tickers = pd.factorize(df['ts_code'])
+T = len(tickers)
+
+print(f"股票: {T}")
 
 def bt(p, s, n, use_vqm):
     """VQM+择时回测"""
@@ -55,7 +55,9 @@ def bt(p, s, n, use_vqm):
         
         init = 1000000.0
         cash = init
-        holdings = {}
+        owned = np.zeros(T, bool)
+        shares = np.zeros(T, np.int64)
+        cost = np.zeros(T)
         
         # 记录每日收益用于计算alpha
         daily_rets = []
@@ -65,20 +67,19 @@ def bt(p, s, n, use_vqm):
             if not mdates: continue
             rd = mdates[0]
             rd_data = yd[yd['trade_date'] == rd]
+            px = snapshot(rd_data, 'close', T)
+            held = owned & ~np.isnan(px)
             
             # 权益
-            hv = sum(holdings[c]['shares'] * float(rd_data[rd_data['ts_code']==c]['close'].iloc[0]) 
-                    for c in holdings if not rd_data[rd_data['ts_code']==c].empty)
+            hv = (shares * px)[held].sum()
             total = cash + hv
             
             # 择时
             trend = idx_dict.get(rd, 1)
             if trend == 0:  # 大盘下跌时空仓
-                for c in list(holdings.keys()):
-                    prc = rd_data[rd_data['ts_code']==c]
-                    if not prc.empty:
-                        cash += holdings[c]['shares'] * float(prc['close'].iloc[0])
-                holdings = {}
+                cash += hv
+                owned[:] = False
+                shares[:] = 0
                 continue
             
             # 选股
@@ -91,34 +92,33 @@ def bt(p, s, n, use_vqm):
             tgt = total * p / len(cand)
             
             # 卖出
-            for c in list(holdings.keys()):
-                if c not in cand['ts_code'].values:
-                    prc = rd_data[rd_data['ts_code']==c]
-                    if not prc.empty:
-                        cash += holdings[c]['shares'] * float(prc['close'].iloc[0])
-                        del holdings[c]
+            in_cand = np.zeros(T, bool)
+            in_cand[cand['tid'].to_numpy()] = True
+            sell = held & ~in_cand
+            cash += (shares * px)[sell].sum()
+            owned[sell] = False
+            shares[sell] = 0
             
             # 买入
-            for _, r in cand.iterrows():
-                if r['ts_code'] not in holdings:
-                    sh = int(tgt / r['close'])
+            for t, c in zip(cand['tid'].to_numpy(), cand['close'].to_numpy()):
+                if not owned[t]:
+                    sh = int(tgt / c)
                     if sh > 0:
-                        holdings[r['ts_code']] = {'shares': sh, 'cost': r['close']}
-                        cash -= sh * r['close']
+                        owned[t] = True
+                        shares[t] = sh
+                        cost[t] = c
+                        cash -= sh * c
             
             # 止损
-            for c in list(holdings.keys()):
-                prc = rd_data[rd_data['ts_code']==c]
-                if not prc.empty:
-                    if (float(prc['close'].iloc[0]) - holdings[c]['cost']) / holdings[c]['cost'] < -s:
-                        cash += holdings[c]['shares'] * float(prc['close'].iloc[0])
-                        del holdings[c]
+            stop = owned & ~np.isnan(px) & (px - cost < -s * cost)
+            cash += (shares * px)[stop].sum()
+            owned[stop] = False
+            shares[stop] = 0
         
         # 年末
         rd = dates[-1]
-        rd_data = yd[yd['trade_date']==rd]
-        fv = cash + sum(holdings[c]['shares'] * float(rd_data[rd_data['ts_code']==c]['close'].iloc[0]) 
-                       for c in holdings if not rd_data[rd_data['ts_code']==c].empty)
+        px = snapshot(yd[yd['trade_date']==rd], 'close', T)
+        fv = cash + (shares * px)[owned & ~np.isnan(px)].sum()
         res.append({'year': y, 'return': (fv - init) / init})
     
     return res
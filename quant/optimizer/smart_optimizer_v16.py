@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 """v16 - 使用补齐的因子数据优化"""
-import sqlite3, pandas as pd
+import pandas as pd
 import numpy as np
 from datetime import datetime
+from _data import load_factors, snapshot
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 
 print("="*50)
@@ -13,14 +13,11 @@ print("="*50)
 
 # 加载因子数据
 print("\n[1] 加载因子数据...")
-df = pd.read_sql("""
-    SELECT ts_code, trade_date, ret_20, ret_60, ret_120, 
-           vol_20, vol_ratio, ma_20, ma_60,
-           price_pos_20, price_pos_60, price_pos_high,
-           vol_ratio_amt, money_flow, rel_strength, mom_accel, profit_mom
-    FROM stock_factors
-    WHERE trade_date BETWEEN '20180101' AND '20211231'
-""", sqlite3.connect(DB))
+df = load_factors('20180101', '20211231', (
+    'ret_20', 'ret_60', 'ret_120',
+    'vol_20', 'vol_ratio', 'ma_20', 'ma_60',
+    'price_pos_20', 'price_pos_60', 'price_pos_high',
+    'vol_ratio_amt', 'money_flow', 'rel_strength', 'mom_accel', 'profit_mom'))
 print(f"因子数据: {len(df)} 条")
 
 # 大盘择时
@@ -30,7 +27,11 @@ idx['ma5'] = idx['ret_20'].rolling(5).mean()
 idx['signal'] = (idx['ma5'] > 0).astype(int)  # 动量正时做多
 idx_dict = dict(zip(idx['trade_date'], idx['signal']))
 
-print(f"股票: {df['ts_code'].nunique()}")
+# 股票编号: 持仓用 tid 下标的平行数组表示
+df['tid'], tickers = pd.factorize(df['ts_code'])
+T = len(tickers)
+
+print(f"股票: {T}")
 
 def bt(p, s, n, mode):
     """多模式回测"""
@@ -41,31 +42,29 @@ def bt(p, s, n, mode):
         
         init = 1000000.0
         cash = init
-        holdings = {}
+        owned = np.zeros(T, bool)
+        shares = np.zeros(T, np.int64)
+        cost_ret = np.zeros(T)
         
         for m in range(1, 13):
             mdates = [d for d in dates if d.startswith(f'{y}{m:02d}')]
             if not mdates: continue
             rd = mdates[0]
             rd_data = yd[yd['trade_date'] == rd]
+            listed = np.zeros(T, bool)
+            listed[rd_data['tid'].to_numpy()] = True
+            cur_ret = snapshot(rd_data, 'ret_20', T)
             
-            # 权益
-            hv = sum(holdings[c]['shares'] * float(rd_data[rd_data['ts_code']==c]['ret_20'].iloc[0]) 
-                    for c in holdings if not rd_data[rd_data['ts_code']==c].empty) * 0  # 简化
-            # 重新计算
-            holdings_val = 0
-            for c in holdings:
-                cd = rd_data[rd_data['ts_code']==c]
-                if not cd.empty:
-                    # 用价格计算需要回查，这里简化用ret_20估算
-                    holdings_val += holdings[c]['shares'] * (1 + holdings[c]['cost_ret'])
+            # 权益 - 用价格计算需要回查，这里简化用ret_20估算
+            holdings_val = (shares * (1 + cost_ret))[owned & listed].sum()
             total = cash + holdings_val
             
             # 择时
             signal = idx_dict.get(rd, 1)
             if signal == 0:
                 cash += holdings_val
-                holdings = {}
+                owned[:] = False
+                shares[:] = 0
                 continue
             
             # 选股 - 不同因子组合
@@ -99,46 +98,38 @@ def bt(p, s, n, mode):
             if cand.empty: continue
             
             # 用ret_20估算当前价格
-            base_prices = rd_data[['ts_code', 'ret_20']].dropna()
+            priced = ~np.isnan(cur_ret)
             tgt = total * p / len(cand)
             
             # 卖出
-            for c in list(holdings.keys()):
-                if c not in cand['ts_code'].values:
-                    ret_row = base_prices[base_prices['ts_code']==c]
-                    if not ret_row.empty:
-                        proceeds = holdings[c]['shares'] * (1 + ret_row['ret_20'].iloc[0])
-                        cash += proceeds
-                        del holdings[c]
+            in_cand = np.zeros(T, bool)
+            in_cand[cand['tid'].to_numpy()] = True
+            sell = owned & priced & ~in_cand
+            cash += (shares * (1 + cur_ret))[sell].sum()
+            owned[sell] = False
+            shares[sell] = 0
             
             # 买入
-            for _, r in cand.iterrows():
-                if r['ts_code'] in holdings: continue
-                price_est = 1 + r['ret_20']  # 简化
+            for t, r20 in zip(cand['tid'].to_numpy(), cand['ret_20'].to_numpy()):
+                if owned[t]: continue
+                price_est = 1 + r20  # 简化
                 sh = int(tgt / price_est)
                 if sh > 0:
-                    holdings[r['ts_code']] = {'shares': sh, 'cost_ret': r['ret_20']}
+                    owned[t] = True
+                    shares[t] = sh
+                    cost_ret[t] = r20
                     cash -= sh * price_est
             
             # 止损
-            for c in list(holdings.keys()):
-                ret_row = base_prices[base_prices['ts_code']==c]
-                if not ret_row.empty:
-                    cur_ret = ret_row['ret_20'].iloc[0]
-                    if cur_ret - holdings[c]['cost_ret'] < -s:
-                        proceeds = holdings[c]['shares'] * (1 + cur_ret)
-                        cash += proceeds
-                        del holdings[c]
+            stop = owned & priced & (cur_ret - cost_ret < -s)
+            cash += (shares * (1 + cur_ret))[stop].sum()
+            owned[stop] = False
+            shares[stop] = 0
         
         # 年末
         rd = dates[-1]
-        rd_data = yd[yd['trade_date']==rd]
-        base = rd_data[['ts_code', 'ret_20']].dropna()
-        fv = cash
-        for c in holdings:
-            br = base[base['ts_code']==c]
-            if not br.empty:
-                fv += holdings[c]['shares'] * (1 + br['ret_20'].iloc[0])
+        cur_ret = snapshot(yd[yd['trade_date']==rd], 'ret_20', T)
+        fv = cash + (shares * (1 + cur_ret))[owned & ~np.isnan(cur_ret)].sum()
         
         res.append({'year': y, 'return': (fv - init) / init})
     
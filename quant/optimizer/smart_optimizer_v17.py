@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 """v17 - 修复版，使用真实价格数据+因子选股"""
-import sqlite3, pandas as pd
+import pandas as pd
 import numpy as np
 from datetime import datetime
+from _data import load_daily, load_factors, snapshot
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 
 print("="*50)
@@ -13,18 +13,12 @@ print("="*50)
 
 # 加载价格数据
 print("\n[1] 加载数据...")
-df = pd.read_sql("""
-    SELECT ts_code, trade_date, close FROM daily_price 
-    WHERE trade_date BETWEEN '20180101' AND '20211231'
-    AND ts_code IN (SELECT ts_code FROM stock_factors GROUP BY ts_code LIMIT 400)
-""", sqlite3.connect(DB))
+df = load_daily('20180101', '20211231', min_days=None, limit=400,
+                cols=('close',), universe='stock_factors')
 
 # 加载因子
-df_fac = pd.read_sql("""
-    SELECT ts_code, trade_date, rel_strength, vol_ratio, mom_accel, price_pos_high
-    FROM stock_factors
-    WHERE trade_date BETWEEN '20180101' AND '20211231'
-""", sqlite3.connect(DB))
+df_fac = load_factors('20180101', '20211231',
+                      ('rel_strength', 'vol_ratio', 'mom_accel', 'price_pos_high'))
 
 # 合并
 df = df.merge(df_fac, on=['ts_code', 'trade_date'], how='left')
@@ -38,96 +32,107 @@ idx['ma5'] = idx['ret20'].rolling(5).mean()
 idx['signal'] = (idx['ma5'] > 0).astype(int)
 idx_dict = dict(zip(idx['trade_date'], idx['signal']))
 
-print(f"股票: {df['ts_code'].nunique()}")
+# 股票编号: 持仓用 tid 下标的平行数组表示
+df['tid'], tickers = pd.factorize(df['ts_code'])
+T = len(tickers)
+
+print(f"股票: {T}")
+
+def select(rd_data, n, mode):
+    """选股 - 只依赖当日因子, 与仓位/止损参数无关"""
+    cand = rd_data[rd_data['ret20'].notna()].copy()
+    
+    if mode == 'alpha':
+        cand = cand.nlargest(n, 'rel_strength')
+    elif mode == 'quality':
+        cand = cand[cand['vol_ratio'] < 1.0]
+        cand = cand.nlargest(n, 'rel_strength')
+    elif mode == 'combo':
+        cand['score'] = (
+            cand['rel_strength'].rank(pct=0.4).fillna(0.5) * 0.4 +
+            (1 - cand['vol_ratio'].rank(pct=0.4)).fillna(0.5) * 0.3 +
+            cand['ret20'].rank(pct=0.4).fillna(0.5) * 0.3
+        )
+        cand = cand.nlargest(n, 'score')
+    else:
+        cand = cand.nlargest(n, 'ret20')
+    
+    return cand['tid'].to_numpy()
+
+# 选股结果只取决于 (mode, n) 和调仓日(每月首个交易日), 在参数网格外一次算好
+NS = [5, 10]
+MODES = ['alpha', 'quality', 'combo', 'momentum']
+rebal = df.groupby(df['trade_date'].str[:6])['trade_date'].min()
+days = dict(tuple(df[df['trade_date'].isin(rebal)].groupby('trade_date')))
+selections = {(mode, n): {rd: select(d, n, mode) for rd, d in days.items()}
+              for mode in MODES for n in NS}
 
 def bt(p, s, n, mode):
     res = []
     for y in ['2018','2019','2020','2021']:
-        yd = df[(df['trade_date'] >= f'{y}0101') & (df['trade_date'] <= f'{y}1231')].copy()
+        yd = df[(df['trade_date'] >= f'{y}0101') & (df['trade_date'] <= f'{y}1231')]
         dates = sorted(yd['trade_date'].unique())
         
         init = 1000000.0
         cash = init
-        holdings = {}
+        owned = np.zeros(T, bool)
+        shares = np.zeros(T, np.int64)
+        cost = np.zeros(T)
         
         for m in range(1, 13):
             mdates = [d for d in dates if d.startswith(f'{y}{m:02d}')]
             if not mdates: continue
             rd = mdates[0]
             rd_data = yd[yd['trade_date'] == rd]
+            px = snapshot(rd_data, 'close', T)
+            held = owned & ~np.isnan(px)
             
             # 权益
-            hv = 0
-            for c in holdings:
-                cd = rd_data[rd_data['ts_code']==c]
-                if not cd.empty:
-                    hv += holdings[c]['shares'] * float(cd['close'].iloc[0])
+            hv = (shares * px)[held].sum()
             total = cash + hv
             
             # 择时
             if idx_dict.get(rd, 1) == 0:
-                for c in list(holdings.keys()):
-                    cd = rd_data[rd_data['ts_code']==c]
-                    if not cd.empty:
-                        cash += holdings[c]['shares'] * float(cd['close'].iloc[0])
-                holdings = {}
+                cash += hv
+                owned[:] = False
+                shares[:] = 0
                 continue
             
             # 选股
-            cand = rd_data[rd_data['ret20'].notna()].copy()
-            
-            if mode == 'alpha':
-                cand = cand.nlargest(n, 'rel_strength')
-            elif mode == 'quality':
-                cand = cand[cand['vol_ratio'] < 1.0]
-                cand = cand.nlargest(n, 'rel_strength')
-            elif mode == 'combo':
-                cand['score'] = (
-                    cand['rel_strength'].rank(pct=0.4).fillna(0.5) * 0.4 +
-                    (1 - cand['vol_ratio'].rank(pct=0.4)).fillna(0.5) * 0.3 +
-                    cand['ret20'].rank(pct=0.4).fillna(0.5) * 0.3
-                )
-                cand = cand.nlargest(n, 'score')
-            else:
-                cand = cand.nlargest(n, 'ret20')
-            
-            if cand.empty: continue
+            cand = selections[(mode, n)][rd]
+            if len(cand) == 0: continue
             
             tgt = total * p / len(cand)
             
             # 卖出
-            for c in list(holdings.keys()):
-                if c not in cand['ts_code'].values:
-                    cd = rd_data[rd_data['ts_code']==c]
-                    if not cd.empty:
-                        cash += holdings[c]['shares'] * float(cd['close'].iloc[0])
-                        del holdings[c]
+            in_cand = np.zeros(T, bool)
+            in_cand[cand] = True
+            sell = held & ~in_cand
+            cash += (shares * px)[sell].sum()
+            owned[sell] = False
+            shares[sell] = 0
             
             # 买入
-            for _, r in cand.iterrows():
-                if r['ts_code'] in holdings: continue
-                sh = int(tgt / r['close'])
+            for t in cand:
+                if owned[t]: continue
+                c = px[t]
+                sh = int(tgt / c)
                 if sh > 0:
-                    holdings[r['ts_code']] = {'shares': sh, 'cost': float(r['close'])}
-                    cash -= sh * r['close']
+                    owned[t] = True
+                    shares[t] = sh
+                    cost[t] = c
+                    cash -= sh * c
             
             # 止损
-            for c in list(holdings.keys()):
-                cd = rd_data[rd_data['ts_code']==c]
-                if not cd.empty:
-                    cur = float(cd['close'].iloc[0])
-                    if (cur - holdings[c]['cost']) / holdings[c]['cost'] < -s:
-                        cash += holdings[c]['shares'] * cur
-                        del holdings[c]
+            stop = owned & ~np.isnan(px) & (px - cost < -s * cost)
+            cash += (shares * px)[stop].sum()
+            owned[stop] = False
+            shares[stop] = 0
         
         # 年末
         rd = dates[-1]
-        rd_data = yd[yd['trade_date']==rd]
-        fv = cash
-        for c in holdings:
-            cd = rd_data[rd_data['ts_code']==c]
-            if not cd.empty:
-                fv += holdings[c]['shares'] * float(cd['close'].iloc[0])
+        px = snapshot(yd[yd['trade_date']==rd], 'close', T)
+        fv = cash + (shares * px)[owned & ~np.isnan(px)].sum()
         
         res.append({'year': y, 'return': (fv - init) / init})
     
@@ -141,8 +146,8 @@ best_avg = -999
 
 for p in [0.3, 0.5, 0.7, 1.0]:
     for s in [0.08, 0.10, 0.15]:
-        for n in [5, 10]:
-            for mode in ['alpha', 'quality', 'combo', 'momentum']:
+        for n in NS:
+            for mode in MODES:
                 r = bt(p, s, n, mode)
                 avg = np.mean([x['return'] for x in r])
                 loss = sum(1 for x in r if x['return'] < 0)
@@ -1,121 +1,71 @@
 #!/usr/bin/env python3
 """v21 - 精简版"""
-import sqlite3, pandas as pd
 import numpy as np
 from datetime import datetime
-import os
+from itertools import product
+from _data import grid_map, rank_pct, top_n
+from _factor_cache import load_or_build, timing_signal
+from _backtest import pad_picks, year_bounds, run_years
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 
 print("="*50)
 print("v21 精简版")
 print("="*50)
 
-# 加载
-df = pd.read_sql("""
-    SELECT ts_code, trade_date, close, volume, amount FROM stock_efinance 
-    WHERE trade_date BETWEEN '20180101' AND '20211231'
-    AND ts_code IN (SELECT DISTINCT ts_code FROM stock_efinance GROUP BY ts_code HAVING COUNT(*) > 900)
-""", sqlite3.connect(DB))
+# 加载数据和因子 (std20: 收盘价20日标准差, money_flow5: 成交额 / 5日均额), 和其它版本共用因子库缓存
+F = load_or_build("SELECT ts_code FROM stock_efinance GROUP BY ts_code HAVING COUNT(*) > 900", 'stock_efinance',
+                  '20180101', '20211231', ['ret20', 'ret60', 'std20', 'ma20', 'money_flow5'])
+close_mat = F['close']
+signal = timing_signal(close_mat, 20)
 
-print(f"股票: {df['ts_code'].nunique()}")
+print(f"股票: {len(F['codes'])}")
 
-# 因子
-df['ret20'] = df.groupby('ts_code')['close'].pct_change(20)
-df['ret60'] = df.groupby('ts_code')['close'].pct_change(60)
-df['vol20'] = df.groupby('ts_code')['close'].rolling(20).std().reset_index(level=0, drop=True)
-df['ma20'] = df.groupby('ts_code')['close'].rolling(20).mean().reset_index(level=0, drop=True)
-df['money_flow'] = df.groupby('ts_code')['amount'].transform(lambda x: x / x.rolling(5).mean())
+# 每年的行号区间和调仓日 (每15个交易日)
+YEARS = ['2018', '2019', '2020', '2021']
+bounds = year_bounds(F['dates'], YEARS)
+rebal = {y: np.arange(lo, hi, 15) for y, (lo, hi) in bounds.items()}
 
-idx = df.groupby('trade_date')['close'].median().reset_index()
-idx['ma20'] = idx['close'].rolling(20).mean()
-idx['signal'] = (idx['close'] > idx['ma20']).astype(int)
-idx_dict = dict(zip(idx['trade_date'], idx['signal']))
+# 选股只和 (调仓日, n, mode) 有关, 与仓位/止损无关: 预先选好, 网格里的每组参数直接复用
+def select(i, n, mode):
+    """单个调仓日的候选股票下标(tid), 按得分从高到低"""
+    tid = np.flatnonzero(~np.isnan(F['ret20'][i]))
+    col = lambda c: F[c][i, tid]
+    
+    if mode == 'combo':
+        # 百分位排名, 缺失按中位0.5
+        r = lambda c: np.nan_to_num(rank_pct(col(c)), nan=0.5)
+        score = (
+            r('ret20') * 0.3 +
+            (1 - r('std20')) * 0.2 +
+            r('money_flow5') * 0.2 +
+            (col('close') > col('ma20')) * 0.3
+        )
+    else:
+        score = col('ret20')
+    
+    return tid[top_n(score, n)]
+
+NS = [5, 10]
+MODES = ['combo']
+picks = {(mode, n): {y: pad_picks([select(i, n, mode) for i in rows], n) for y, rows in rebal.items()}
+         for mode in MODES for n in NS}
 
 def bt(p, s, n, mode):
-    res = []
-    for y in ['2018','2019','2020','2021']:
-        yd = df[(df['trade_date'] >= f'{y}0101') & (df['trade_date'] <= f'{y}1231')]
-        dates = sorted(yd['trade_date'].unique())
-        
-        init = 1000000.0
-        cash = init
-        h = {}
-        
-        for rd in dates[::15]:
-            rd_d = yd[yd['trade_date']==rd]
-            hv = sum(h[c]['s'] * float(rd_d[rd_d['ts_code']==c]['close'].iloc[0]) 
-                    for c in h if not rd_d[rd_d['ts_code']==c].empty)
-            tot = cash + hv
-            
-            if idx_dict.get(rd, 1) == 0:
-                for c in list(h.keys()):
-                    cd = rd_d[rd_d['ts_code']==c]
-                    if not cd.empty:
-                        cash += h[c]['s'] * float(cd['close'].iloc[0])
-                h = {}
-                continue
-            
-            cand = rd_d[rd_d['ret20'].notna()].copy()
-            
-            if mode == 'combo':
-                cand['score'] = (
-                    cand['ret20'].rank(pct=0.4).fillna(0.5) * 0.3 +
-                    (1 - cand['vol20'].rank(pct=0.4)).fillna(0.5) * 0.2 +
-                    cand['money_flow'].rank(pct=0.4).fillna(0.5) * 0.2 +
-                    (cand['close'] > cand['ma20']).astype(float) * 0.3
-                )
-            else:
-                cand['score'] = cand['ret20']
-            
-            cand = cand.nlargest(n, 'score')
-            if cand.empty: continue
-            
-            tgt = tot * p / len(cand)
-            
-            for c in list(h.keys()):
-                if c not in cand['ts_code'].values:
-                    cd = rd_d[rd_d['ts_code']==c]
-                    if not cd.empty:
-                        cash += h[c]['s'] * float(cd['close'].iloc[0])
-                        del h[c]
-            
-            for _, r in cand.iterrows():
-                if r['ts_code'] not in h:
-                    sh = int(tgt / r['close'])
-                    if sh > 0:
-                        h[r['ts_code']] = {'s': sh, 'p': r['close']}
-                        cash -= sh * r['close']
-            
-            for c in list(h.keys()):
-                cd = rd_d[rd_d['ts_code']==c]
-                if not cd.empty:
-                    if (float(cd['close'].iloc[0]) - h[c]['p']) / h[c]['p'] < -s:
-                        cash += h[c]['s'] * float(cd['close'].iloc[0])
-                        del h[c]
-        
-        rd = dates[-1]
-        rd_d = yd[yd['trade_date']==rd]
-        fv = cash + sum(h[c]['s'] * float(rd_d[rd_d['ts_code']==c]['close'].iloc[0]) 
-                       for c in h if not rd_d[rd_d['ts_code']==c].empty)
-        res.append({'year': y, 'return': (fv - init) / init})
-    
-    return res
+    return run_years(close_mat, signal, bounds, rebal, picks[(mode, n)], p, s)
 
 # 测试
 best, best_r = None, None
 best_avg = -999
 
-for p in [0.3, 0.5, 0.7, 1.0]:
-    for s in [0.08, 0.10, 0.15]:
-        for n in [5, 10]:
-            r = bt(p, s, n, 'combo')
-            avg = np.mean([x['return'] for x in r])
-            loss = sum(1 for x in r if x['return'] < 0)
-            score = avg - loss * 0.1
-            if score > best_avg:
-                best_avg, best, best_r = score, {'p':p,'s':s,'n':n}, r
+grid = list(product([0.3, 0.5, 0.7, 1.0], [0.08, 0.10, 0.15], NS, MODES))
+bt(*grid[0])  # 主进程先编译回测内核, fork出的子进程直接复用
+for (p, s, n, _), r in zip(grid, grid_map(bt, grid)):
+    avg = np.mean([x['return'] for x in r])
+    loss = sum(1 for x in r if x['return'] < 0)
+    score = avg - loss * 0.1
+    if score > best_avg:
+        best_avg, best, best_r = score, {'p':p,'s':s,'n':n}, r
 
 yearly = [f"{d['year']}: {d['return']*100:+.1f}%" for d in best_r]
 avg = np.mean([d['return'] for d in best_r]) * 100
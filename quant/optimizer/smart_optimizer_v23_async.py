@@ -1,33 +1,97 @@
 #!/usr/bin/env python3
 """v23 - 增强版多因子 (异步汇报版)
 每轮迭代都写入报告文件"""
-import sqlite3, pandas as pd
 import numpy as np
 from datetime import datetime
+from itertools import product
+from _data import grid_map
+from _factor_cache import load_panel
+from _backtest import year_bounds, rebal_plan, run_years
+import atexit
 import os
+import signal as sig
+import sys
+import time
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 REPORT_FILE = f'{OUT}/latest_report.txt'
 ITERATION_FILE = f'{OUT}/iteration_log.txt'
+GRID = list(product([0.3, 0.5, 0.7, 1.0], [0.05, 0.08, 0.10, 0.15], [3, 5, 8, 10], [10, 15, 20]))
+
+# 迭代日志先攒在内存里, 攒够一批或隔一段时间再追加到文件
+LOG_BATCH = 100
+LOG_INTERVAL = 5  # 秒
+log_buffer = []
+last_flush = time.time()
+MAIN_PID = os.getpid()
+
+
+def flush_log():
+    """把缓冲的迭代日志追加写入文件 (只在主进程写, fork出的子进程不重复写)"""
+    global last_flush
+    last_flush = time.time()
+    if not log_buffer or os.getpid() != MAIN_PID:
+        return
+    # 先把缓冲换下来再写: 写的过程中被 SIGTERM 打断时, atexit 里的这次调用不会把同一批再写一遍
+    buf, log_buffer[:] = log_buffer[:], []
+    with open(ITERATION_FILE, 'a') as f:
+        f.write(''.join(buf))
+
+
+def maybe_flush():
+    """攒够一批或离上次写出超过 LOG_INTERVAL 秒就写出"""
+    if len(log_buffer) >= LOG_BATCH or time.time() - last_flush > LOG_INTERVAL:
+        flush_log()
+
 
 def write_report(content, iteration=None):
     """写入报告文件"""
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    # 主报告文件 - 始终是最新结果
-    with open(REPORT_FILE, 'w') as f:
+    # 主报告文件 - 始终是最新结果; 先写临时文件再替换, 读的一方不会看到写了一半的内容
+    tmp = f'{REPORT_FILE}.tmp'
+    with open(tmp, 'w') as f:
         f.write(f"📊 **v23 优化汇报** ({ts})")
         if iteration:
             f.write(f" - 第{iteration}轮迭代")
         f.write(f"\n\n{content}\n")
+    os.replace(tmp, REPORT_FILE)
     
     # 迭代日志 - 追加所有结果
-    with open(ITERATION_FILE, 'a') as f:
-        f.write(f"\n[{ts}] ")
-        if iteration:
-            f.write(f"迭代{iteration}: ")
-        f.write(f"{content}\n")
+    log_buffer.append(f"\n[{ts}] " + (f"迭代{iteration}: " if iteration else "") + f"{content}\n")
+    maybe_flush()
+
+# 回测用的宽表, load() 填好; 网格子进程fork时直接继承, 不用逐个任务传
+close_mat = score_mat = year_rows = signal = plan = None
+
+
+def load():
+    """加载行情和因子, 算好综合评分/择时, 转成宽表"""
+    global close_mat, score_mat, year_rows, signal, plan
+    
+    # 综合评分: 各因子按交易日截面排名后加权, 负权重表示越低越好; 择时: 收盘价截面中位数站上20日均线
+    close_mat, score_mat, signal, codes, dates_all = load_panel({
+        'ret_20': 0.20,
+        'ret_60': 0.15,
+        'mom_accel': 0.15,
+        'vol_20': -0.15,
+        'money_flow': 0.15,
+        'price_pos_20': 0.20,
+    })
+    
+    print(f"股票数: {len(codes)}")
+    
+    # 每年在日期轴上的行号区间 [lo, hi), 只算一次, 网格里直接复用
+    year_rows = year_bounds(dates_all, ['2018','2019','2020','2021'])
+    # 每种调仓间隔的调仓日和候选只选一次 (按最大持仓数), 各组参数只是查表
+    plan = rebal_plan(score_mat, year_rows, [g[3] for g in GRID], max(g[2] for g in GRID))
+
+
+def bt(p, s, n, rebal=15):
+    rows, picks = plan[rebal]
+    return run_years(close_mat, signal, year_rows, rows, {y: m[:, :n] for y, m in picks.items()},
+                     p, s, min_days=20, tp=0.15)
+
 
 def main():
     print("="*60)
@@ -37,134 +101,34 @@ def main():
     # 清空迭代日志
     with open(ITERATION_FILE, 'w') as f:
         f.write(f"=== v23 优化迭代日志 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===\n")
+    # 正常退出或被 kill (SIGTERM) 时把没写出去的日志补上
+    atexit.register(flush_log)
+    sig.signal(sig.SIGTERM, lambda *_: sys.exit(128 + sig.SIGTERM))
     
-    conn = sqlite3.connect(DB)
-    df = pd.read_sql("""
-        SELECT e.ts_code, e.trade_date, e.close, e.volume, e.amount,
-               f.ret_20, f.ret_60, f.ret_120, f.vol_20, f.vol_ratio, f.ma_20, f.ma_60,
-               f.money_flow, f.rel_strength, f.mom_accel, f.price_pos_20, f.price_pos_60
-        FROM stock_efinance e
-        LEFT JOIN stock_factors f ON e.ts_code = f.ts_code AND e.trade_date = f.trade_date
-        WHERE e.trade_date BETWEEN '20180101' AND '20211231'
-        AND e.ts_code IN (SELECT DISTINCT ts_code FROM stock_efinance GROUP BY ts_code HAVING COUNT(*) > 900)
-    """, conn)
-    
-    conn.close()
-    df = df[df['ret_20'].notna()]
-    
-    print(f"股票数: {df['ts_code'].nunique()}")
-    
-    # 增强因子
-    df['mom_20_60'] = df['ret_20'] - df['ret_60']
-    df['price_strength'] = df['price_pos_20'] * df['ret_20']
-    df['fund_quality'] = df['money_flow'] * df['rel_strength']
-    
-    # 综合评分
-    df['score'] = (
-        df['ret_20'].rank(pct=True) * 0.20 +
-        df['ret_60'].rank(pct=True) * 0.15 +
-        df['mom_accel'].rank(pct=True) * 0.15 +
-        (1 - df['vol_20'].rank(pct=True)) * 0.15 +
-        df['money_flow'].rank(pct=True) * 0.15 +
-        df['price_pos_20'].rank(pct=True) * 0.20
-    )
-    
-    # 择时
-    idx = df.groupby('trade_date')['close'].median().reset_index()
-    idx['ma20'] = idx['close'].rolling(20).mean()
-    idx['ma60'] = idx['close'].rolling(60).mean()
-    idx['trend'] = (idx['close'] > idx['ma20']).astype(int)
-    idx_dict = dict(zip(idx['trade_date'], idx['trend']))
-    
-    def bt(p, s, n, rebal=15):
-        res = []
-        for y in ['2018','2019','2020','2021']:
-            yd = df[(df['trade_date'] >= f'{y}0101') & (df['trade_date'] <= f'{y}1231')]
-            dates = sorted(yd['trade_date'].unique())
-            if len(dates) < 20: continue
-            
-            init = 1000000.0
-            cash = init
-            h = {}
-            
-            for rd in dates[::rebal]:
-                rd_d = yd[yd['trade_date']==rd]
-                
-                hv = sum(h[c]['s'] * float(rd_d[rd_d['ts_code']==c]['close'].iloc[0]) 
-                        for c in h if not rd_d[rd_d['ts_code']==c].empty)
-                tot = cash + hv
-                
-                if idx_dict.get(rd, 1) == 0:
-                    for c in list(h.keys()):
-                        cd = rd_d[rd_d['ts_code']==c]
-                        if not cd.empty:
-                            cash += h[c]['s'] * float(cd['close'].iloc[0])
-                    h = {}
-                    continue
-                
-                cand = rd_d[rd_d['score'].notna()].nlargest(n, 'score')
-                if cand.empty: continue
-                
-                tgt = tot * p / len(cand)
-                
-                for c in list(h.keys()):
-                    if c not in cand['ts_code'].values:
-                        cd = rd_d[rd_d['ts_code']==c]
-                        if not cd.empty:
-                            cash += h[c]['s'] * float(cd['close'].iloc[0])
-                            del h[c]
-                
-                for _, r in cand.iterrows():
-                    if r['ts_code'] not in h:
-                        sh = int(tgt / r['close'])
-                        if sh > 0:
-                            h[r['ts_code']] = {'s': sh, 'p': r['close']}
-                            cash -= sh * r['close']
-                
-                for c in list(h.keys()):
-                    cd = rd_d[rd_d['ts_code']==c]
-                    if not cd.empty:
-                        ret = (float(cd['close'].iloc[0]) - h[c]['p']) / h[c]['p']
-                        if ret < -s:
-                            cash += h[c]['s'] * float(cd['close'].iloc[0])
-                            del h[c]
-                        elif ret > 0.15:
-                            cash += h[c]['s'] * float(cd['close'].iloc[0])
-                            del h[c]
-            
-            rd = dates[-1]
-            rd_d = yd[yd['trade_date']==rd]
-            fv = cash + sum(h[c]['s'] * float(rd_d[rd_d['ts_code']==c]['close'].iloc[0]) 
-                           for c in h if not rd_d[rd_d['ts_code']==c].empty)
-            res.append({'year': y, 'return': (fv - init) / init})
-        
-        return res
+    load()
     
     print("\n[回测...]")
     best, best_r, best_avg = None, None, -999
-    iteration = 0
-    total_iterations = len([0.3, 0.5, 0.7, 1.0]) * len([0.05, 0.08, 0.10, 0.15]) * len([3, 5, 8, 10]) * len([10, 15, 20])
+    grid = GRID
+    total_iterations = len(grid)
     
-    for p in [0.3, 0.5, 0.7, 1.0]:
-        for s in [0.05, 0.08, 0.10, 0.15]:
-            for n in [3, 5, 8, 10]:
-                for rebal in [10, 15, 20]:
-                    iteration += 1
-                    r = bt(p, s, n, rebal)
-                    if not r: continue
-                    avg = np.mean([x['return'] for x in r])
-                    loss = sum(1 for x in r if x['return'] < 0)
-                    score = avg - loss * 0.1
-                    
-                    yearly_str = " | ".join([f"{d['year']}: {d['return']*100:+.1f}%" for d in r])
-                    
-                    if score > best_avg:
-                        best_avg = score
-                        best = {'p':p,'s':s,'n':n,'rebal':rebal}
-                        best_r = r
-                        
-                        # 写入报告 - 发现更优解时
-                        report_content = f"""🏆 发现更优参数组合 ({iteration}/{total_iterations})
+    # 各组参数互不依赖, 多进程跑; 结果按网格顺序陆续返回, 发现更优解就写报告
+    for iteration, ((p, s, n, rebal), r) in enumerate(zip(grid, grid_map(bt, grid)), 1):
+        maybe_flush()  # 每收到一组结果都按时间检查一次, 不必等下一次发现更优解
+        if not r: continue
+        avg = np.mean([x['return'] for x in r])
+        loss = sum(1 for x in r if x['return'] < 0)
+        score = avg - loss * 0.1
+        
+        yearly_str = " | ".join([f"{d['year']}: {d['return']*100:+.1f}%" for d in r])
+        
+        if score > best_avg:
+            best_avg = score
+            best = {'p':p,'s':s,'n':n,'rebal':rebal}
+            best_r = r
+            
+            # 写入报告 - 发现更优解时
+            report_content = f"""🏆 发现更优参数组合 ({iteration}/{total_iterations})
 
 参数: 仓位{best['p']*100:.0f}% | 止损{best['s']*100:.0f}% | 持仓{best['n']}只 | 调仓{best['rebal']}天
 
@@ -174,9 +138,9 @@ def main():
 平均收益: {avg*100:+.1f}%
 亏损年份: {loss}年
 综合评分: {score:.3f}"""
-                        
-                        write_report(report_content, iteration)
-                        print(f"\n  📝 第{iteration}轮: 仓位{best['p']*100:.0f}% 止损{best['s']*100:.0f}% = {avg*100:+.1f}%")
+            
+            write_report(report_content, iteration)
+            print(f"\n  📝 第{iteration}轮: 仓位{best['p']*100:.0f}% 止损{best['s']*100:.0f}% = {avg*100:+.1f}%")
     
     if best_r:
         yearly = [f"{d['year']}: {d['return']*100:+.1f}%" for d in best_r]
@@ -202,6 +166,7 @@ def main():
 ⏰ 完成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
         
         write_report(final_report, "最终")
+        flush_log()
         print("\n✅ 完成")
 
 if __name__ == "__main__":
@@ -1,155 +1,63 @@
 #!/usr/bin/env python3
 """v24 - 终极多因子版"""
-import sqlite3, pandas as pd
 import numpy as np
 from datetime import datetime
+from itertools import product
+from _data import grid_map
+from _factor_cache import load_panel
+from _backtest import year_bounds, rebal_plan, run_years
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 
 print("="*60)
 print("v24 终极多因子版")
 print("="*60)
 
-conn = sqlite3.connect(DB)
-df = pd.read_sql("""
-    SELECT e.ts_code, e.trade_date, e.close, e.volume, e.amount,
-           f.ret_20, f.ret_60, f.ret_120, f.vol_20, f.vol_ratio, f.vol_ratio_amt,
-           f.ma_20, f.ma_60, f.price_pos_20, f.price_pos_60, f.price_pos_high,
-           f.money_flow, f.rel_strength, f.mom_accel, f.profit_mom
-    FROM stock_efinance e
-    LEFT JOIN stock_factors f ON e.ts_code = f.ts_code AND e.trade_date = f.trade_date
-    WHERE e.trade_date BETWEEN '20180101' AND '20211231'
-    AND e.ts_code IN (SELECT DISTINCT ts_code FROM stock_efinance GROUP BY ts_code HAVING COUNT(*) > 900)
-""", conn)
-conn.close()
+# 综合评分 (更多因子): 各因子按交易日截面排名后加权, 负权重表示越低越好
+WEIGHTS = {
+    'ret_20': 0.12,
+    'ret_60': 0.08,
+    'mom_accel': 0.10,
+    'vol_20': -0.08,  # 低波动
+    'money_flow': 0.10,
+    'price_pos_20': 0.10,  # 趋势位置
+    'price_pos_high': 0.08,  # 年内高位
+    'profit_mom': 0.10,  # 盈利动量
+    'rel_strength': 0.08,  # 相对强度
+    'mom_trend': 0.08,  # 趋势确认
+    'break_high': 0.08,  # 突破新高
+}
+# 择时 (更严格): 收盘价截面中位数站上20日均线且20日线在60日线之上
+close_mat, score_mat, signal, codes, dates_all = load_panel(WEIGHTS, slow=60)
 
-print(f"股票数: {df['ts_code'].nunique()}")
-df = df[df['ret_20'].notna()]
+print(f"股票数: {len(codes)}")
 
-# ============ 增强因子 ============
-# 动量因子
-df['mom_20_60'] = df['ret_20'] - df['ret_60']  # 动量加速
-df['mom_60_120'] = df['ret_60'] - df['ret_120']  # 中期动量
-df['mom_trend'] = (df['ret_20'] > df['ret_60']).astype(float)  # 趋势确认
+# 每年在日期轴上的行号区间 [lo, hi), 只算一次, 网格里直接复用
+year_rows = year_bounds(dates_all, ['2018','2019','2020','2021'])
 
-# 质量因子
-df['price_strength'] = df['price_pos_20'] * df['ret_20']  # 强度
-df['fund_quality'] = df['money_flow'] * df['rel_strength']  # 资金质量
-df['profit_momentum'] = df['profit_mom'].fillna(0) * df['ret_20']  # 盈利动量
-
-# 趋势位置因子
-df['high_pos_score'] = df['price_pos_high'].fillna(0.5)  # 年内高位
-df['break_high'] = (df['price_pos_20'] > 0.8).astype(float)  # 突破新高
-
-# 波动性因子
-df['low_vol_quality'] = (1 / (df['vol_20'] + 0.01)) * df['rel_strength']  # 低波动优质
-
-# 综合评分 (更多因子)
-df['score'] = (
-    df['ret_20'].rank(pct=True) * 0.12 +
-    df['ret_60'].rank(pct=True) * 0.08 +
-    df['mom_accel'].rank(pct=True) * 0.10 +
-    (1 - df['vol_20'].rank(pct=True)) * 0.08 +  # 低波动
-    df['money_flow'].rank(pct=True) * 0.10 +
-    df['price_pos_20'].rank(pct=True) * 0.10 +  # 趋势位置
-    df['price_pos_high'].rank(pct=True) * 0.08 +  # 年内高位
-    df['profit_mom'].rank(pct=True) * 0.10 +  # 盈利动量
-    df['rel_strength'].rank(pct=True) * 0.08 +  # 相对强度
-    df['mom_trend'].rank(pct=True) * 0.08 +  # 趋势确认
-    df['break_high'].rank(pct=True) * 0.08  # 突破新高
-)
-
-# 择时 (更严格)
-idx = df.groupby('trade_date')['close'].median().reset_index()
-idx['ma20'] = idx['close'].rolling(20).mean()
-idx['ma60'] = idx['close'].rolling(60).mean()
-idx['trend'] = ((idx['close'] > idx['ma20']) & (idx['ma20'] > idx['ma60'])).astype(int)
-idx_dict = dict(zip(idx['trade_date'], idx['trend']))
+# 扩大搜索范围
+grid = list(product([0.3, 0.5, 0.7, 1.0], [0.05, 0.08, 0.10, 0.15, 0.20], [3, 5, 8, 10], [5, 10, 15, 20]))
+# 每种调仓间隔的调仓日和候选只选一次 (按最大持仓数), 各组参数只是查表
+plan = rebal_plan(score_mat, year_rows, [g[3] for g in grid], max(g[2] for g in grid))
 
 def bt(p, s, n, rebal=10):
-    res = []
-    for y in ['2018','2019','2020','2021']:
-        yd = df[(df['trade_date'] >= f'{y}0101') & (df['trade_date'] <= f'{y}1231')]
-        dates = sorted(yd['trade_date'].unique())
-        if len(dates) < 20: continue
-        
-        init = 1000000.0
-        cash = init
-        h = {}
-        
-        for rd in dates[::rebal]:
-            rd_d = yd[yd['trade_date']==rd]
-            
-            hv = sum(h[c]['s'] * float(rd_d[rd_d['ts_code']==c]['close'].iloc[0]) 
-                    for c in h if not rd_d[rd_d['ts_code']==c].empty)
-            tot = cash + hv
-            
-            # 择时
-            if idx_dict.get(rd, 1) == 0:
-                for c in list(h.keys()):
-                    cd = rd_d[rd_d['ts_code']==c]
-                    if not cd.empty:
-                        cash += h[c]['s'] * float(cd['close'].iloc[0])
-                h = {}
-                continue
-            
-            cand = rd_d[rd_d['score'].notna()].nlargest(n, 'score')
-            if cand.empty: continue
-            
-            tgt = tot * p / len(cand)
-            
-            for c in list(h.keys()):
-                if c not in cand['ts_code'].values:
-                    cd = rd_d[rd_d['ts_code']==c]
-                    if not cd.empty:
-                        cash += h[c]['s'] * float(cd['close'].iloc[0])
-                        del h[c]
-            
-            for _, r in cand.iterrows():
-                if r['ts_code'] not in h:
-                    sh = int(tgt / r['close'])
-                    if sh > 0:
-                        h[r['ts_code']] = {'s': sh, 'p': r['close']}
-                        cash -= sh * r['close']
-            
-            # 止损/止盈
-            for c in list(h.keys()):
-                cd = rd_d[rd_d['ts_code']==c]
-                if not cd.empty:
-                    ret = (float(cd['close'].iloc[0]) - h[c]['p']) / h[c]['p']
-                    if ret < -s:  # 止损
-                        cash += h[c]['s'] * float(cd['close'].iloc[0])
-                        del h[c]
-                    elif ret > 0.20:  # 止盈20%
-                        cash += h[c]['s'] * float(cd['close'].iloc[0])
-                        del h[c]
-        
-        rd = dates[-1]
-        rd_d = yd[yd['trade_date']==rd]
-        fv = cash + sum(h[c]['s'] * float(rd_d[rd_d['ts_code']==c]['close'].iloc[0]) 
-                       for c in h if not rd_d[rd_d['ts_code']==c].empty)
-        res.append({'year': y, 'return': (fv - init) / init})
-    
-    return res
+    rows, picks = plan[rebal]
+    return run_years(close_mat, signal, year_rows, rows, {y: m[:, :n] for y, m in picks.items()},
+                     p, s, min_days=20, tp=0.20)
 
 print("[回测...]")
 best, best_r, best_avg = None, None, -999
 
-# 扩大搜索范围
-for p in [0.3, 0.5, 0.7, 1.0]:
-    for s in [0.05, 0.08, 0.10, 0.15, 0.20]:
-        for n in [3, 5, 8, 10]:
-            for rebal in [5, 10, 15, 20]:
-                r = bt(p, s, n, rebal)
-                if not r: continue
-                avg = np.mean([x['return'] for x in r])
-                loss = sum(1 for x in r if x['return'] < 0)
-                score = avg - loss * 0.15  # 惩罚亏损年份
-                if score > best_avg:
-                    best_avg = score
-                    best = {'p':p,'s':s,'n':n,'rebal':rebal}
-                    best_r = r
+# 各组参数互不依赖, 多进程跑; 按网格顺序取最优, 结果与串行一致
+for (p, s, n, rebal), r in zip(grid, grid_map(bt, grid)):
+    if not r: continue
+    avg = np.mean([x['return'] for x in r])
+    loss = sum(1 for x in r if x['return'] < 0)
+    score = avg - loss * 0.15  # 惩罚亏损年份
+    if score > best_avg:
+        best_avg = score
+        best = {'p':p,'s':s,'n':n,'rebal':rebal}
+        best_r = r
 
 if best_r:
     yearly = [f"{d['year']}: {d['return']*100:+.1f}%" for d in best_r]
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 """智能版策略优化器 - 结合板块轮动与市场环境"""
-import sqlite3, pandas as pd, numpy as np, json, random
+import pandas as pd, numpy as np, json, random, warnings
 from datetime import datetime
+import threading
 import requests
+from _data import grid_map
+from _factor_cache import load_momentum
+from _backtest import ACTIONS, rebal_rows, schedule_picks, run_rebal
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 USER_ID = 'ou_efbad805767f4572e8f93ebafa8d5402'
 
@@ -12,178 +15,55 @@ print("="*60)
 print("📊 智能策略优化器 v3.0 - 板块轮动版")
 print("="*60)
 
-# 加载数据
+# 加载数据 + 指标 + 宽表 (与v4/v6/v7共用)
+# 选股：动量+趋势过滤 (60日均线在上, 20日涨幅>0); 持仓当天不满足条件时不调出也不止损
 print("\n[1] 加载数据...")
-df = pd.read_sql("""
-    SELECT ts_code, trade_date, close, volume
-    FROM daily_price 
-    WHERE trade_date BETWEEN '20150101' AND '20211231'
-    AND ts_code IN (SELECT ts_code FROM daily_price GROUP BY ts_code HAVING COUNT(*)>200)
-""", sqlite3.connect(DB))
-
-# 计算各种指标
+close, ret20, ok, mom, _, dates, codes = load_momentum('20150101', 200, ret60=True)
+
 print("[2] 计算技术指标...")
-df['ret20'] = df.groupby('ts_code')['close'].pct_change(20)
-df['ret60'] = df.groupby('ts_code')['close'].pct_change(60)
-df['ret120'] = df.groupby('ts_code')['close'].pct_change(120)
-df['vol20'] = df.groupby('ts_code')['volume'].rolling(20).mean().reset_index(level=0, drop=True)
-df['price_ma20'] = df.groupby('ts_code')['close'].rolling(20).mean().reset_index(level=0, drop=True)
-df['price_ma60'] = df.groupby('ts_code')['close'].rolling(60).mean().reset_index(level=0, drop=True)
-
-print(f"    股票数量: {df['ts_code'].nunique()}")
-
-def get_market_env(ydf, date):
-    """判断市场环境"""
-    mkt = ydf[ydf['trade_date'] == date]
-    if mkt.empty:
-        return 'neutral'
-    
-    # 用所有股票的20日涨幅中位数判断市场
-    median_ret = mkt['ret20'].median()
-    if median_ret > 0.05:
-        return 'bull'
-    elif median_ret < -0.05:
-        return 'bear'
-    return 'neutral'
-
-def smart_backtest(params):
-    """智能回测 - 结合市场环境"""
-    years = ['2018', '2019', '2020', '2021']
+
+# 市场环境: 所有股票20日涨幅的截面中位数 >5% 牛市, <-5% 熊市, 其余震荡 (当天全是NaN也算震荡)
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    median_ret = np.nanmedian(ret20, axis=1)
+env = np.where(median_ret > 0.05, 'bull', np.where(median_ret < -0.05, 'bear', 'neutral'))
+# 根据市场环境调整仓位: 熊市只做3成仓, 震荡做6成, 牛市满仓
+mult = np.select([median_ret > 0.05, median_ret < -0.05], [1.0, 0.3], 0.6)
+
+print(f"    股票数量: {len(codes)}")
+
+# 每月第一个交易日调仓 (交易日不足100天的年份跳过), 调仓日只算一次
+schedule = rebal_rows(dates, ['2018', '2019', '2020', '2021'], min_days=100)
+
+def trade_record(t):
+    """run_rebal 的交易记录 -> 报告里的交易明细"""
+    row, action, j, shares, price, entry = t
+    row, j, shares, action = int(row), int(j), int(shares), ACTIONS[int(action)]
+    rec = {'date': dates[row], 'action': action, 'stock': codes[j], 'shares': shares,
+           'price': round(float(price), 2), 'value': round(shares * price, 2)}
+    if action == 'SELL':
+        rec['reason'] = 'rebalance'
+    elif action == 'STOP_LOSS':
+        rec['return_pct'] = round((price - entry) / entry * 100, 2)
+        rec['reason'] = 'stop_loss'
+    else:
+        rec['ret20'] = round(float(ret20[row, j]) * 100, 2)
+    return rec
+
+def smart_backtest(params, log=False):
+    """智能回测 - 结合市场环境; log=True 时才记录交易明细和权益曲线 (只给最优参数出报告用)"""
     yearly_results = []
     
-    for year in years:
-        ydf = df[(df['trade_date'] >= f'{year}0101') & (df['trade_date'] <= f'{year}1231')]
-        dts = sorted(ydf['trade_date'].unique())
-        if len(dts) < 100:
-            continue
-        
+    for year, (reb, end) in schedule.items():
         # 初始化
         cap = 1000000
-        cash = cap
-        holdings = {}
-        trades = []
-        equity_curve = []
-        
-        # 每月第一个交易日调仓
-        for m in range(1, 13):
-            md = [d for d in dts if d.startswith(f'{year}{m:02d}')]
-            if not md:
-                continue
-            
-            rebalance_date = md[0]
-            cd = ydf[ydf['trade_date'] == rebalance_date]
-            
-            # 判断市场环境
-            market_env = get_market_env(ydf, rebalance_date)
-            
-            # 根据市场环境调整仓位
-            if market_env == 'bear':
-                position_ratio = params['p'] * 0.3  # 熊市只做3成仓
-            elif market_env == 'neutral':
-                position_ratio = params['p'] * 0.6  # 震荡做6成
-            else:
-                position_ratio = params['p']  # 牛市满仓
-            
-            position = cap * position_ratio
-            
-            # 选股：动量+趋势过滤
-            cd = cd[cd['ret20'].notna() & cd['ret60'].notna()]
-            
-            # 趋势过滤：60日均线在上
-            cd = cd[cd['close'] > cd['price_ma60']]
-            
-            # 动量过滤：20日涨幅>0
-            cd = cd[cd['ret20'] > 0]
-            
-            # 按动量排序，选top N
-            top_n = cd.nlargest(params['n_stock'], 'ret20')
-            
-            # 目标持仓
-            target_value = position / len(top_n) if len(top_n) > 0 else 0
-            
-            # 调仓：卖出不在topN的
-            for h in list(holdings.keys()):
-                if h not in top_n['ts_code'].values:
-                    hdata = cd[cd['ts_code'] == h]
-                    if hdata.empty:
-                        continue
-                    sell_price = float(hdata['close'].iloc[0])
-                    proceeds = holdings[h]['shares'] * sell_price
-                    cash += proceeds
-                    trades.append({
-                        'date': rebalance_date,
-                        'action': 'SELL',
-                        'stock': h,
-                        'shares': holdings[h]['shares'],
-                        'price': round(sell_price, 2),
-                        'value': round(proceeds, 2),
-                        'reason': 'rebalance'
-                    })
-                    del holdings[h]
-            
-            # 止损检查
-            for h in list(holdings.keys()):
-                hdata = cd[cd['ts_code'] == h]
-                if not hdata.empty:
-                    current_price = float(hdata['close'].iloc[0])
-                    ret = (current_price - holdings[h]['entry_price']) / holdings[h]['entry_price']
-                    if ret < -params['s']:
-                        proceeds = holdings[h]['shares'] * current_price
-                        cash += proceeds
-                        trades.append({
-                            'date': rebalance_date,
-                            'action': 'STOP_LOSS',
-                            'stock': h,
-                            'shares': holdings[h]['shares'],
-                            'price': round(current_price, 2),
-                            'value': round(proceeds, 2),
-                            'return_pct': round(ret * 100, 2),
-                            'reason': 'stop_loss'
-                        })
-                        del holdings[h]
-            
-            # 买入新持仓
-            for _, row in top_n.iterrows():
-                if row['ts_code'] in holdings:
-                    continue
-                if cash < target_value:
-                    break
-                shares = int(target_value / row['close'])
-                if shares > 0:
-                    cost = shares * row['close']
-                    cash -= cost
-                    holdings[row['ts_code']] = {
-                        'shares': shares,
-                        'entry_price': float(row['close']),
-                        'entry_date': rebalance_date
-                    }
-                    trades.append({
-                        'date': rebalance_date,
-                        'action': 'BUY',
-                        'stock': row['ts_code'],
-                        'shares': shares,
-                        'price': round(float(row['close']), 2),
-                        'value': round(cost, 2),
-                        'ret20': round(float(row['ret20']) * 100, 2)
-                    })
-            
-            # 记录权益
-            holdings_value = 0
-            for h in holdings.keys():
-                hdata = cd[cd['ts_code'] == h]
-                if not hdata.empty:
-                    holdings_value += holdings[h]['shares'] * float(hdata['close'].iloc[0])
-            total = cash + holdings_value
-            equity_curve.append({'date': rebalance_date, 'equity': total, 'env': market_env})
         
-        # 年末结算
-        final_date = dts[-1]
-        fd = ydf[ydf['trade_date'] == final_date]
-        final_value = cash
-        for h in holdings.keys():
-            hdata = fd[fd['ts_code'] == h]
-            if not hdata.empty:
-                final_value += holdings[h]['shares'] * float(hdata['close'].iloc[0])
+        # 按动量排序选top N; 仓位按市场环境打折 (mult)
+        picks = cand[year][:, :params['n_stock']]
+        final_value, n_trades, tlog, eq = run_rebal(close, ok, reb, picks, end, params['p'], params['s'],
+                                                    mult=mult, init=cap, keep=20 if log else 0, curve=log)
+        trades = [trade_record(t) for t in tlog]
+        equity_curve = [{'date': dates[r], 'equity': float(e), 'env': str(env[r])} for r, e in zip(reb, eq)]
         
         yearly_ret = (final_value - cap) / cap
         
@@ -192,19 +72,16 @@ def smart_backtest(params):
             'return_pct': round(yearly_ret * 100, 2),
             'initial_capital': cap,
             'final_value': round(final_value, 2),
-            'trades_count': len(trades),
-            'trades': trades[-20:],  # 只保存最后20条
+            'trades_count': n_trades,
+            'trades': trades,  # 只保存最后20条
             'equity_curve': equity_curve
         })
     
-    # 汇总
-    total_return = sum(r['return_pct'] for r in yearly_results) / len(yearly_results) if yearly_results else 0
-    max_drawdown = 0
-    for yr in yearly_results:
-        peak = yr['initial_capital']
-        if yr['final_value'] < peak:
-            dd = (peak - yr['final_value']) / peak
-            max_drawdown = max(max_drawdown, dd)
+    # 汇总: 各年收益/资金摊成数组一次算完; 回撤 = 各年期末相对年初资金的最大亏损比例, 都不亏为0
+    ret, peak, fv = (np.array([r[k] for r in yearly_results], float)
+                     for k in ('return_pct', 'initial_capital', 'final_value'))
+    total_return = float(ret.mean()) if len(ret) else 0
+    max_drawdown = float(np.max((peak - fv) / peak, initial=0))
     
     return {
         'avg_return_pct': round(total_return, 2),
@@ -228,8 +105,10 @@ best_return = -999
 best_drawdown = 999
 
 print(f"    测试 {len(param_grid)} 组参数...")
-for params in param_grid:
-    result = smart_backtest(params)
+# 各组参数的选股只差持仓数, 按最大持仓数每个调仓日选一次, 回测里取前n只
+cand = schedule_picks(mom, schedule, max(prm['n_stock'] for prm in param_grid))
+# 各组参数互不依赖, 多进程跑; 结果按网格顺序返回, 取最优的逻辑与串行一致
+for params, result in zip(param_grid, grid_map(smart_backtest, [(prm,) for prm in param_grid])):
     ret = result['avg_return_pct']
     dd = result['max_drawdown_pct']
     
@@ -240,7 +119,9 @@ for params in param_grid:
         best_return = ret
         best_drawdown = dd
         best_params = params
-        best_result = result
+
+# 网格里不记明细, 最优参数重跑一遍取交易记录和权益曲线
+best_result = smart_backtest(best_params, log=True)
 
 print(f"\n[4] 最优参数:")
 print(f"    基础仓位: {best_params['p']*100:.0f}%")
@@ -335,16 +216,22 @@ msg = f"""📊 **智能策略优化完成！**
 
 详细报告: {report_file}"""
 
-try:
-    resp = requests.post(
-        'http://localhost:8000/message/send',
-        json={"to": USER_ID, "message": msg},
-        timeout=5
-    )
-    print(f"    发送状态: {resp.status_code}")
-except Exception as e:
-    print(f"    发送失败: {e}")
+def send(msg):
+    try:
+        resp = requests.post(
+            'http://localhost:8000/message/send',
+            json={"to": USER_ID, "message": msg},
+            timeout=5
+        )
+        print(f"    发送状态: {resp.status_code}")
+    except Exception as e:
+        print(f"    发送失败: {e}")
+
+# 后台线程发送, 报告已落盘, 发送和收尾输出并行; 退出前等它跑完 (请求自带5秒超时), 结果总会打印出来
+sender = threading.Thread(target=send, args=(msg,))
+sender.start()
 
 print("\n" + "="*60)
 print("✅ 优化完成！")
 print("="*60)
+sender.join()
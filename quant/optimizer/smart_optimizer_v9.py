@@ -1,90 +1,44 @@
 #!/usr/bin/env python3
 """智能优化器 v9 - 修复索引bug"""
-import sqlite3, pandas as pd, numpy as np
+import pandas as pd, numpy as np
 from datetime import datetime
+from itertools import product
+from _data import load_daily, add_axes, panel, grid_map, group_pct_change
+from _backtest import rebal_rows, schedule_picks, run_rebal
+from _factor_cache import timing_signal
 
-DB = '/root/.openclaw/workspace/data/historical/historical.db'
 OUT = '/root/.openclaw/workspace/quant/optimizer'
 
 print("="*40)
 print("v9 优化中...")
 
-# 取500只股票
-df = pd.read_sql("""
-    SELECT ts_code, trade_date, close FROM daily_price 
-    WHERE trade_date BETWEEN '20180101' AND '20211231'
-    AND ts_code IN (SELECT ts_code FROM daily_price GROUP BY ts_code HAVING COUNT(*) > 200 LIMIT 500)
-""", sqlite3.connect(DB))
+# 取500只股票 (交易超过200天的前500只); 股票池单独查一次, 主查询按 ts_code IN (?, ...) 走主键, 结果有磁盘缓存
+df = load_daily('20180101', '20211231', 200, limit=500, cols=('close',))
+df['trade_date'] = df['trade_date'].astype(np.int32)  # YYYYMMDD 整数, 比较/分组/查表不再走字符串
 
-df['ret20'] = df.groupby('ts_code')['close'].pct_change(20)
+df['ret20'] = group_pct_change(df, 'close', 20)  # 一次向量计算, 不逐组分派
 df = df.dropna(subset=['ret20'])
 
-# 大盘
-idx = df.groupby('trade_date')['close'].median().reset_index()
-idx['ma20'] = idx['close'].rolling(20).mean()
-idx_dict = dict(zip(idx['trade_date'], (idx['close'] > idx['ma20']).astype(int)))
-
 print(f"股票: {df['ts_code'].nunique()}")
 
+# 摊成 [日期, 股票] 宽表: 回测里按 行号/股票下标 直接取当天价格和动量, 不再逐只过滤长表
+dates, codes = add_axes(df)
+shape = (len(dates), len(codes))
+close, ret20 = (panel(df, c, shape) for c in ('close', 'ret20'))
+# 每年的调仓日 (每20个交易日) 和年末行号只算一次, 各组参数共用
+schedule = rebal_rows(dates, ['2018', '2019', '2020', '2021'], step=20)
+ok = ~np.isnan(close)  # 当天有数据才能卖出
+signal = timing_signal(close, 20)  # 大盘择时: 收盘价截面中位数站上20日线, 与日期轴逐行对齐的int8数组
+# 收益率/择时用float64算好后价格转float32, 回测内核读的数据减半; 动量保持float64 (float32会让排名出现并列)
+close = close.astype(np.float32)
+
 def bt(p, s, n):
     res = []
-    for y in ['2018','2019','2020','2021']:
-        yd = df[(df['trade_date'] >= f'{y}0101') & (df['trade_date'] <= f'{y}1231')]
-        dts = sorted(yd['trade_date'].unique())[::20]
-        
+    for y, (dts, end) in schedule.items():
         cap = 1000000
-        cash = cap
-        h = {}
-        
-        for rd in dts:
-            # 用当日全部数据计算权益
-            rd_all = yd[yd['trade_date']==rd]
-            eq = cash
-            for k in h:
-                kd = rd_all[rd_all['ts_code']==k]
-                if not kd.empty:
-                    eq += h[k]['s'] * float(kd['close'].iloc[0])
-            
-            mkt = idx_dict.get(rd, 1)
-            if mkt == 0:
-                for k in list(h.keys()):
-                    kd = rd_all[rd_all['ts_code']==k]
-                    if not kd.empty:
-                        cash += h[k]['s'] * float(kd['close'].iloc[0])
-                h = {}
-                continue
-            
-            # 选股
-            cd = yd[yd['trade_date']==rd].nlargest(n, 'ret20')
-            if cd.empty: continue
-            
-            tgt = eq * p / len(cd)
-            
-            # 卖出
-            for k in list(h.keys()):
-                kd = cd[cd['ts_code']==k]
-                if kd.empty:
-                    # 不在top里，尝试用当日收盘价卖出
-                    kd_all = rd_all[rd_all['ts_code']==k]
-                    if not kd_all.empty:
-                        cash += h[k]['s'] * float(kd_all['close'].iloc[0])
-                        del h[k]
-            
-            # 买入
-            for _, r in cd.iterrows():
-                if r['ts_code'] not in h:
-                    sh = int(tgt / r['close'])
-                    if sh > 0: h[r['ts_code']] = {'s': sh, 'p': r['close']}
-        
-        # 年末
-        rd = sorted(yd['trade_date'].unique())[-1]
-        rd_all = yd[yd['trade_date']==rd]
-        fv = cash
-        for k in h:
-            kd = rd_all[rd_all['ts_code']==k]
-            if not kd.empty:
-                fv += h[k]['s'] * float(kd['close'].iloc[0])
-        
+        # 调仓内核 (numba编译): 按当前权益算仓位, 不在top里且当天有价就卖, 买入不扣现金, 不止损
+        fv, _, _, _ = run_rebal(close, ok, dts, cand[y][:, :n], end, p, np.inf, signal=signal, init=cap,
+                                rolling=True, deduct=False)
         res.append({'year': y, 'ret': (fv-cap)/cap, 'final': fv})
     return res
 
@@ -92,13 +46,14 @@ def bt(p, s, n):
 best, best_r = {'p':0.5,'s':0.15,'n':5}, None
 best_avg = -999
 
-for p in [0.3, 0.5, 0.7]:
-    for s in [0.10, 0.15]:
-        for n in [5, 8]:
-            r = bt(p, s, n)
-            avg = np.mean([x['ret'] for x in r])
-            if avg > best_avg:
-                best_avg, best, best_r = avg, {'p':p,'s':s,'n':n}, r
+# 各组参数互不依赖, 多进程跑; 结果按网格顺序返回, 取最优的逻辑与串行一致
+grid = list(product([0.3, 0.5, 0.7], [0.10, 0.15], [5, 8]))
+# 选股只差持仓数, 每个调仓日按最大持仓数选一次, 回测里取前n只
+cand = schedule_picks(ret20, schedule, max(n for _, _, n in grid))
+for (p, s, n), r in zip(grid, grid_map(bt, grid)):
+    avg = np.mean([x['ret'] for x in r])
+    if avg > best_avg:
+        best_avg, best, best_r = avg, {'p':p,'s':s,'n':n}, r
 
 yearly = [f"{d['year']}: {d['ret']*100:+.1f}%" for d in best_r]
 avg = np.mean([d['ret'] for d in best_r]) * 100
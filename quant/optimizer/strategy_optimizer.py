@@ -3,151 +3,183 @@
 投资策略优化器 - 每日22:00-08:00运行
 每15分钟进行一轮优化
 """
-import sqlite3
 import pandas as pd
 import numpy as np
 import json
 import random
 import time
 from datetime import datetime
-import os
+from _data import db_stamp, disk_cache, connect, add_axes, panel, top_n, grid_map, group_pct_change, group_rolling
+from _backtest import rebal_rows
 
-DB_PATH = '/root/.openclaw/workspace/data/historical/historical.db'
 OUTPUT_DIR = '/root/.openclaw/workspace/quant/optimizer'
+# 宽表计算版本: 改了 _load_from_db 的计算就加1, 旧缓存自动作废
+DATA_VERSION = 1
+
+def industry(codes):
+    """按代码段分行业: 科创/创业板/金融/消费/其他, 整个代码数组一次向量判断"""
+    c = pd.Series(codes).str.split('.').str[0].astype(int).to_numpy()
+    return np.select([c >= 688000, (c >= 300000) & (c < 301000), (c >= 600000) & (c < 600200),
+                      (c >= 600500) & (c < 600600)], ['科创', '创业板', '金融', '消费'], '其他')
 
 def load_data():
-    """加载数据"""
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql("""
-        SELECT ts_code, trade_date, close, volume 
-        FROM daily_price 
-        WHERE trade_date BETWEEN '20180101' AND '20211231'
-    """, conn)
-    conn.close()
-    
-    # 行业分类
-    def get_ind(code):
-        c = int(code.split('.')[0])
-        if c >= 688000: return '科创'
-        if 300000 <= c < 301000: return '创业板'
-        if 600000 <= c < 600200: return '金融'
-        if 600500 <= c < 600600: return '消费'
-        return '其他'
-    
-    df['ind'] = df['ts_code'].apply(get_ind)
+    """加载数据
+
+    处理好的宽表缓存到 cache/strategy_data.pkl, 每15分钟一轮只要库没更新就直接读缓存,
+    不再重新查库和计算指标; 库更新或 DATA_VERSION 变了就重算并覆盖这一个文件
+    """
+    data = disk_cache('strategy_data', (db_stamp(), DATA_VERSION), _load_from_db)
+    # 每年各月第一个交易日和年末的行号只算一次, 各组参数的回测直接查表 (不足100个交易日的年份不测)
+    data['months'] = rebal_rows(data['dates'], ['2018','2019','2020','2021'], min_days=100)
+    return data
+
+def _load_from_db():
+    # 只读连接: 开mmap和64MB页缓存 (每轮是独立进程, 库没更新时直接读 load_data 的缓存, 不到这里)
+    conn = connect()
+    try:
+        df = pd.read_sql("""
+            SELECT ts_code, trade_date, close, volume 
+            FROM daily_price 
+            WHERE trade_date BETWEEN '20180101' AND '20211231'
+        """, conn)
+    finally:
+        conn.close()
+    df['trade_date'] = df['trade_date'].astype(np.int32)  # YYYYMMDD 整数, 日期比较不再走字符串
+    
     df = df.sort_values(['ts_code','trade_date'])
-    df['ret20'] = df.groupby('ts_code')['close'].pct_change(20)
-    df['ret60'] = df.groupby('ts_code')['close'].pct_change(60)
-    df['volma20'] = df.groupby('ts_code')['volume'].transform(lambda x: x.rolling(20).mean())
+    df['ret20'] = group_pct_change(df, 'close', 20)
+    df['ret60'] = group_pct_change(df, 'close', 60)
+    df['volma20'] = group_rolling(df, 'volume', 20)  # 所有股票一次向量计算, 不逐组调lambda
     df['volratio'] = df['volume'] / df['volma20']
     
-    return df
+    # 摊成 [日期, 股票] 宽表, 回测里按 行号/股票下标 直接取值, 不再每只持仓过滤一遍当天数据
+    dates, codes = add_axes(df)
+    shape = (len(dates), len(codes))
+    data = {'dates': dates, 'codes': codes, 'ind': industry(codes)}
+    # 收益率用float64算好后价格存float32, 回测读的数据减半; 收益率保持float64 (float32会让排名出现并列)
+    data['close'] = panel(df, 'close', shape, np.float32)
+    for c in ('ret20', 'ret60', 'volratio'):
+        data[c] = panel(df, c, shape)
+    return data
 
-def backtest(params, df):
+def backtest(params, data):
     """单次回测"""
     position = params.get('position', 0.7)
     stop_loss = params.get('stop_loss', 0.20)
     rebal_days = params.get('rebalance_days', 20)
     
+    dates, close, ret20, ret60 = data['dates'], data['close'], data['ret20'], data['ret60']
+    # 各行业的股票掩码, 选股时把行业外的得分置为NaN
+    inds = [data['ind'] == ind_n for ind_n in ['创业板','科创','消费','金融']]
+    
     yearly = []
-    for year in ['2018','2019','2020','2021']:
-        ydf = df[(df['trade_date'] >= f'{year}0101') & (df['trade_date'] <= f'{year}1231')]
-        dates = sorted(ydf['trade_date'].unique())
-        if len(dates) < 100:
-            continue
-        
+    for m_rows, end_row in data['months'].values():
         capital = 1000000
         cash = capital * (1 - position)
-        holdings = {}
+        holdings = {}  # 股票下标 -> 持仓
         
         # 初始建仓
-        init_date = dates[20]
-        init_df = ydf[ydf['trade_date'] == init_date]
+        init_row = m_rows[0] + 20  # 年内第21个交易日
+        px = close[init_row].astype(float)  # 价格存float32, 取出的一行转float64再算股数/市值
         
-        for ind_n in ['创业板','科创','消费','金融']:
-            ind_df = init_df[(init_df['ind']==ind_n) & init_df['ret20'].notna()]
-            if len(ind_df) > 0:
-                top = ind_df.nlargest(2, 'ret20')
-                for _, r in top.iterrows():
-                    if r['close'] > 0:
-                        shares = int(capital * position / 8 / r['close'])
-                        holdings[r['ts_code']] = {'shares': shares, 'cost': r['close']}
+        for m in inds:
+            for j in top_n(np.where(m, ret20[init_row], np.nan), 2):
+                if px[j] > 0:
+                    shares = int(capital * position / 8 / px[j])
+                    holdings[j] = {'shares': shares, 'cost': px[j]}
         
-        # 调仓
-        for month in range(2, 13):
-            m_dates = [d for d in dates if d.startswith(f'{year}{month:02d}')]
-            if not m_dates:
+        # 调仓: 2~12月各月第一个交易日
+        for check_row in m_rows:
+            month = dates[check_row] // 100 % 100
+            if month < 2:
                 continue
             
-            check_date = m_dates[0]
-            check_df = ydf[ydf['trade_date'] == check_date]
-            market = check_df['ret20'].median()
+            px = close[check_row].astype(float)
+            market = pd.Series(ret20[check_row]).median()
             
             if market > 0.05:
-                score_col = 'ret20'
+                score = ret20
             elif market < -0.05:
-                score_col = 'ret60'
+                score = ret60
             else:
-                score_col = 'ret20'
+                score = ret20
             
-            # 止损
-            for code in list(holdings.keys()):
-                d = check_df[check_df['ts_code']==code]
-                if not d.empty:
-                    pnl = (d['close'].iloc[0] - holdings[code]['cost']) / holdings[code]['cost']
-                    if pnl < -stop_loss:
-                        cash += holdings[code]['shares'] * d['close'].iloc[0]
-                        del holdings[code]
+            # 止损 (当天没有数据的持仓价格为NaN, 不触发)
+            for j in list(holdings.keys()):
+                pnl = (px[j] - holdings[j]['cost']) / holdings[j]['cost']
+                if pnl < -stop_loss:
+                    cash += holdings[j]['shares'] * px[j]
+                    del holdings[j]
             
             # 调仓
-            if month % max(1, rebal_days // 30) == 0:
-                while len(holdings) < 8:
-                    added = False
-                    for ind_n in ['创业板','科创','消费','金融']:
-                        valid = check_df[(check_df['ind']==ind_n) & check_df[score_col].notna()]
-                        if len(valid) > 0:
-                            top = valid.nlargest(2, score_col)
-                            for _, r in top.iterrows():
-                                if r['ts_code'] not in holdings and r['close'] > 0:
-                                    shares = int(capital * position / 8 / r['close'])
-                                    holdings[r['ts_code']] = {'shares': shares, 'cost': r['close']}
-                                    cash -= shares * r['close']
-                                    added = True
-                                    break
-                        if added:
+            if month % max(1, rebal_days // 30) == 0 and len(holdings) < 8:
+                # 各行业按得分取前2只, 按行业顺序依次补仓到8只; 候选每月只选一次, 不再每补一只重扫一遍
+                for m in inds:
+                    for j in top_n(np.where(m, score[check_row], np.nan), 2):
+                        if len(holdings) >= 8:
                             break
-                    if not added:
-                        break
+                        if j not in holdings and px[j] > 0:
+                            shares = int(capital * position / 8 / px[j])
+                            holdings[j] = {'shares': shares, 'cost': px[j]}
+                            cash -= shares * px[j]
         
         # 年末结算
-        final_df = ydf[ydf['trade_date'] == dates[-1]]
-        fv = cash + sum(h['shares'] * final_df[final_df['ts_code']==c]['close'].iloc[0] 
-                       for c,h in holdings.items() if not final_df[final_df['ts_code']==c].empty)
+        px = close[end_row].astype(float)
+        fv = cash + sum(h['shares'] * px[j] for j, h in holdings.items() if not np.isnan(px[j]))
         
         yearly.append((fv - capital) / capital)
     
     return sum(yearly) / 4 if yearly else -1
 
-def random_params():
-    """随机生成参数"""
-    return {
-        'position': random.choice([0.5, 0.6, 0.7, 0.8]),
-        'stop_loss': random.choice([0.10, 0.15, 0.20, 0.25]),
-        'rebalance_days': random.choice([15, 20, 30, 45]),
-        'momentum_weight': random.uniform(0.5, 1.0),
-        'reverse_weight': random.uniform(0, 0.5),
-    }
+def halton(n, d):
+    """Halton 低差异序列的前n个点 (d维, 依次以2, 3, 5, 7, 11...为底), 取值 [0, 1)"""
+    primes = [2, 3, 5, 7, 11, 13, 17, 19][:d]
+    out = np.zeros((n, d))
+    for k, b in enumerate(primes):
+        i, f = np.arange(1, n + 1), 1.0
+        while i.any():
+            f /= b
+            out[:, k] += f * (i % b)
+            i //= b
+    return out
+
+
+def sample_params(n):
+    """生成n组参数
+
+    Halton 序列整体加一个随机平移 (每轮位置不同), 点在参数空间里铺得比逐个随机抽更均匀,
+    同样的回测次数覆盖更全。离散参数按所在区间取候选值。
+    """
+    pts = (halton(n, 5) + [random.random() for _ in range(5)]) % 1.0
+    pick = lambda opts, x: opts[int(x * len(opts))]
+    return [{
+        'position': pick([0.5, 0.6, 0.7, 0.8], x[0]),
+        'stop_loss': pick([0.10, 0.15, 0.20, 0.25], x[1]),
+        'rebalance_days': pick([15, 20, 30, 45], x[2]),
+        'momentum_weight': float(0.5 + 0.5 * x[3]),
+        'reverse_weight': float(0.5 * x[4]),
+    } for x in pts]
+
+# optimize() 加载好的行情; grid_map 的子进程fork时直接继承, 不用逐个任务pickle
+_data = None
+
+
+def _backtest_loaded(params):
+    """在 optimize() 已加载的行情上回测 (grid_map 要求顶层函数)"""
+    return backtest(params, _data)
+
 
 def optimize():
     """优化主函数"""
+    global _data
     print(f"\n{'='*60}")
     print(f"🧪 策略优化轮次 - {datetime.now().strftime('%H:%M:%S')}")
     print(f"{'='*60}")
     
     # 加载数据
     print("加载数据...")
-    df = load_data()
-    print(f"数据: {df['ts_code'].nunique()}只股票")
+    data = _data = load_data()
+    print(f"数据: {len(data['codes'])}只股票")
     
     # 随机选择模拟时间点
     years = ['2018','2019','2020','2021']
@@ -163,10 +195,9 @@ def optimize():
     best_avg = -999
     best_params = None
     
-    for i in range(100):
-        params = random_params()
-        avg = backtest(params, df)
-        
+    # 参数先全部生成, 各次回测互不依赖, 多进程跑; 结果按生成顺序返回, 取最优的逻辑与串行一致
+    param_list = sample_params(100)
+    for i, (params, avg) in enumerate(zip(param_list, grid_map(_backtest_loaded, [(prm,) for prm in param_list]))):
         results.append({
             'params': params,
             'avg_return': avg,
@@ -183,16 +214,17 @@ def optimize():
     # 保存结果
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     
+    # 先整体编码成字符串再一次写入, 不按片段逐块 write; default=str 兜底万一混进来的 numpy 标量
     result_file = f"{OUTPUT_DIR}/result_{timestamp}.json"
     with open(result_file, 'w') as f:
-        json.dump({
+        f.write(json.dumps({
             'timestamp': timestamp,
             'sim_date': sim_date,
             'total_simulations': 100,
             'best_params': best_params,
             'best_return': best_avg,
             'all_results': results
-        }, f, indent=2, default=str)
+        }, indent=2, default=str))
     
     # 更新最佳参数
     best_file = f"{OUTPUT_DIR}/best_params.json"
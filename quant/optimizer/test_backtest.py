@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""run_rebal 与原 v3 逐只dict循环的数值等价性测试 (随机种子生成的合成行情)"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from _backtest import rebal_rows, schedule_picks, run_rebal
+
+YEARS = ['2018', '2019']
+
+
+def make_panel(seed, n_stocks=30):
+    """合成 [日期, 股票] 行情: 随机游走收盘价, 约3%停牌 (NaN), ok 为随机通过选股过滤"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2018-01-01', '2019-12-31').strftime('%Y%m%d').astype(int).to_numpy()
+    close = 10 * np.exp(np.cumsum(rng.normal(0, 0.03, (len(dates), n_stocks)), axis=0))
+    close[rng.random(close.shape) < 0.03] = np.nan
+    ret20 = rng.normal(0.02, 0.1, close.shape)
+    ok = ~np.isnan(close) & (ret20 > 0) & (rng.random(close.shape) < 0.7)
+    mult = rng.choice([0.3, 0.6, 1.0], len(dates))  # 市场环境对应的仓位系数
+    codes = np.array([f'{i:06d}.SZ' for i in range(n_stocks)])
+    return dates, codes, close, ret20, ok, mult
+
+
+def dict_loop(dates, codes, close, ret20, ok, mult, reb, end, p, s, n, cap=1000000):
+    """原 v3 smart_backtest 单年部分: 持仓dict, 按当天长表逐只过滤"""
+    df = pd.DataFrame({
+        'ts_code': np.tile(codes, len(dates)),
+        'trade_date': np.repeat(dates, len(codes)),
+        'close': close.ravel(),
+        'ret20': ret20.ravel(),
+        'ok': ok.ravel(),
+    })
+    df = df[df['close'].notna()]  # 停牌日库里没有这一行
+    cash = cap
+    holdings = {}
+    trades = 0
+    equity = []
+    for r in reb:
+        day = df[df['trade_date'] == dates[r]]
+        cd = day[day['ok']]
+        top = cd.nlargest(n, 'ret20')
+        target_value = cap * p * mult[r] / len(top) if len(top) > 0 else 0
+
+        for h in list(holdings):
+            if h not in top['ts_code'].values:
+                hdata = cd[cd['ts_code'] == h]
+                if hdata.empty:
+                    continue
+                cash += holdings[h]['shares'] * float(hdata['close'].iloc[0])
+                trades += 1
+                del holdings[h]
+
+        for h in list(holdings):
+            hdata = cd[cd['ts_code'] == h]
+            if not hdata.empty:
+                price = float(hdata['close'].iloc[0])
+                if (price - holdings[h]['entry_price']) / holdings[h]['entry_price'] < -s:
+                    cash += holdings[h]['shares'] * price
+                    trades += 1
+                    del holdings[h]
+
+        for _, row in top.iterrows():
+            if row['ts_code'] in holdings:
+                continue
+            if cash < target_value:
+                break
+            shares = int(target_value / row['close'])
+            if shares > 0:
+                cash -= shares * row['close']
+                holdings[row['ts_code']] = {'shares': shares, 'entry_price': float(row['close'])}
+                trades += 1
+
+        hv = 0
+        for h in holdings:
+            hdata = cd[cd['ts_code'] == h]
+            if not hdata.empty:
+                hv += holdings[h]['shares'] * float(hdata['close'].iloc[0])
+        equity.append(cash + hv)
+
+    fd = df[df['trade_date'] == dates[end]]
+    final_value = cash
+    for h in holdings:
+        hdata = fd[fd['ts_code'] == h]
+        if not hdata.empty:
+            final_value += holdings[h]['shares'] * float(hdata['close'].iloc[0])
+    return final_value, trades, np.array(equity)
+
+
+def max_drawdown(final_values, cap=1000000):
+    """与 v3 汇总相同: 各年年末相对初始资金的最大亏损"""
+    return max([(cap - fv) / cap for fv in final_values if fv < cap], default=0)
+
+
+@pytest.mark.parametrize('seed, p, s, n', [(0, 0.7, 0.10, 5), (1, 0.5, 0.15, 8), (2, 1.0, 0.05, 3)])
+def test_run_rebal_matches_dict_loop(seed, p, s, n):
+    dates, codes, close, ret20, ok, mult = make_panel(seed)
+    schedule = rebal_rows(dates, YEARS)
+    cand = schedule_picks(np.where(ok, ret20, np.nan), schedule, n)
+
+    old_fv, new_fv = [], []
+    for y, (reb, end) in schedule.items():
+        fv0, n0, eq0 = dict_loop(dates, codes, close, ret20, ok, mult, reb, end, p, s, n)
+        fv1, n1, _, eq1 = run_rebal(close, ok, reb, cand[y], end, p, s, mult=mult, curve=True)
+        assert fv1 == pytest.approx(fv0, rel=1e-12)
+        assert n1 == n0
+        np.testing.assert_allclose(eq1, eq0, rtol=1e-12)
+        old_fv.append(fv0)
+        new_fv.append(fv1)
+    assert max_drawdown(new_fv) == pytest.approx(max_drawdown(old_fv), rel=1e-12)
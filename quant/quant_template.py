@@ -1,81 +1,162 @@
 """
 量化回测基础模板
-基于Backtrader的单因子回测框架
+PE单因子回测: 默认用向量化回测 (run_vectorized_backtest), 需要券商撮合细节时用Backtrader (run_backtest)
 """
 
-import backtrader as bt
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import akshare as ak
 
-class PEFactorStrategy(bt.Strategy):
-    """
-    PE因子策略：买入低PE股票，卖出高PE股票
-    """
-    params = (
-        ('pe_threshold_low', 10),   # 低PE阈值
-        ('pe_threshold_high', 30),  # 高PE阈值
-        ('rebalance_days', 20),     # 再平衡周期（交易日）
-    )
-    
-    def __init__(self):
-        self.dataclose = self.datas[0].close
-        self.datape = self.datas[0].pe  # 需要PE数据
-        self.order = None
-        self.rebalance_counter = 0
+# Backtrader 只有 run_backtest 用到, 没装时向量化回测照常可用
+try:
+    import backtrader as bt
+    BACKTRADER_AVAILABLE = True
+except ImportError:
+    BACKTRADER_AVAILABLE = False
+
+if BACKTRADER_AVAILABLE:
+    class PEFactorStrategy(bt.Strategy):
+        """
+        PE因子策略：买入低PE股票，卖出高PE股票
+        """
+        params = (
+            ('pe_threshold_low', 10),   # 低PE阈值
+            ('pe_threshold_high', 30),  # 高PE阈值
+            ('rebalance_days', 20),     # 再平衡周期（交易日）
+        )
+    
+        def __init__(self):
+            self.dataclose = self.datas[0].close
+            self.datape = self.datas[0].pe  # 需要PE数据
+            self.order = None
+            self.rebalance_counter = 0
         
-    def log(self, txt, dt=None):
-        """日志函数"""
-        dt = dt or self.datas[0].datetime.date(0)
-        print(f'{dt.isoformat()} {txt}')
+        def log(self, txt, dt=None):
+            """日志函数"""
+            dt = dt or self.datas[0].datetime.date(0)
+            print(f'{dt.isoformat()} {txt}')
         
-    def next(self):
-        """每个交易日执行"""
-        # 检查是否有待处理订单
-        if self.order:
-            return
+        def next(self):
+            """每个交易日执行"""
+            # 检查是否有待处理订单
+            if self.order:
+                return
             
-        # 再平衡计数
-        self.rebalance_counter += 1
-        if self.rebalance_counter % self.params.rebalance_days != 0:
-            return
+            # 再平衡计数
+            self.rebalance_counter += 1
+            if self.rebalance_counter % self.params.rebalance_days != 0:
+                return
             
-        # 获取当前PE
-        current_pe = self.datape[0]
+            # 获取当前PE
+            current_pe = self.datape[0]
         
-        # 策略逻辑
-        if not self.position:  # 没有持仓
-            if current_pe < self.params.pe_threshold_low:
-                # 低PE买入
-                self.log(f'BUY CREATE, Price: {self.dataclose[0]:.2f}, PE: {current_pe:.2f}')
-                self.order = self.buy()
-        else:  # 有持仓
-            if current_pe > self.params.pe_threshold_high:
-                # 高PE卖出
-                self.log(f'SELL CREATE, Price: {self.dataclose[0]:.2f}, PE: {current_pe:.2f}')
-                self.order = self.sell()
+            # 策略逻辑
+            if not self.position:  # 没有持仓
+                if current_pe < self.params.pe_threshold_low:
+                    # 低PE买入
+                    self.log(f'BUY CREATE, Price: {self.dataclose[0]:.2f}, PE: {current_pe:.2f}')
+                    self.order = self.buy()
+            else:  # 有持仓
+                if current_pe > self.params.pe_threshold_high:
+                    # 高PE卖出
+                    self.log(f'SELL CREATE, Price: {self.dataclose[0]:.2f}, PE: {current_pe:.2f}')
+                    self.order = self.sell()
                 
-    def notify_order(self, order):
-        """订单状态回调"""
-        if order.status in [order.Submitted, order.Accepted]:
-            return
+        def notify_order(self, order):
+            """订单状态回调"""
+            if order.status in [order.Submitted, order.Accepted]:
+                return
             
-        if order.status in [order.Completed]:
-            if order.isbuy():
-                self.log(f'BUY EXECUTED, Price: {order.executed.price:.2f}, Cost: {order.executed.value:.2f}')
-            else:
-                self.log(f'SELL EXECUTED, Price: {order.executed.price:.2f}, Cost: {order.executed.value:.2f}')
-        elif order.status in [order.Canceled, order.Margin, order.Rejected]:
-            self.log('Order Canceled/Margin/Rejected')
+            if order.status in [order.Completed]:
+                if order.isbuy():
+                    self.log(f'BUY EXECUTED, Price: {order.executed.price:.2f}, Cost: {order.executed.value:.2f}')
+                else:
+                    self.log(f'SELL EXECUTED, Price: {order.executed.price:.2f}, Cost: {order.executed.value:.2f}')
+            elif order.status in [order.Canceled, order.Margin, order.Rejected]:
+                self.log('Order Canceled/Margin/Rejected')
             
-        self.order = None
+            self.order = None
         
-    def notify_trade(self, trade):
-        """交易完成回调"""
-        if not trade.isclosed:
-            return
-        self.log(f'TRADE PROFIT, GROSS: {trade.pnl:.2f}, NET: {trade.pnlcomm:.2f}')
+        def notify_trade(self, trade):
+            """交易完成回调"""
+            if not trade.isclosed:
+                return
+            self.log(f'TRADE PROFIT, GROSS: {trade.pnl:.2f}, NET: {trade.pnlcomm:.2f}')
+
+
+def make_demo_data(start_date='20200101', end_date='20241231'):
+    """生成模拟行情和PE数据 (实际使用时替换为真实数据), 按交易日索引"""
+    dates = pd.date_range(start=start_date, end=end_date, freq='B')
+    n = len(dates)
+    np.random.seed(42)
+    data = pd.DataFrame({
+        'datetime': dates,
+        'open': 100 + np.cumsum(np.random.randn(n) * 0.5),
+        'high': 100 + np.cumsum(np.random.randn(n) * 0.5) + 2,
+        'low': 100 + np.cumsum(np.random.randn(n) * 0.5) - 2,
+        'close': 100 + np.cumsum(np.random.randn(n) * 0.5),
+        'volume': np.random.randint(1000000, 5000000, n),
+        'pe': np.random.uniform(5, 40, n),  # 模拟PE数据
+    })
+    return data.set_index('datetime')
+
+
+def pe_position(pe, low=10, high=30, rebalance_days=20):
+    """PE信号 -> 每日收盘后的持仓 (1持有 / 0空仓)
+
+    与 PEFactorStrategy 同样的规则: 每rebalance_days个交易日检查一次, 空仓时PE低于low买入,
+    持仓时PE高于high卖出, 其余时间持仓不变。整列一次算完, 不逐bar回调。
+    """
+    pe = np.asarray(pe, float)
+    n = len(pe)
+    sig = np.zeros(n, np.int8)
+    chk = np.arange(rebalance_days - 1, n, rebalance_days)
+    sig[chk] = np.where(pe[chk] < low, 1, np.where(pe[chk] > high, -1, 0))
+    # 持仓由最近一次买/卖信号决定: 买入后一直持有到卖出信号
+    last = np.maximum.accumulate(np.where(sig != 0, np.arange(n), -1))
+    return ((last >= 0) & (sig[np.maximum(last, 0)] > 0)).astype(np.int8)
+
+
+def run_vectorized_backtest(data=None, start_date='20200101', end_date='20241231', cash=1000000.0,
+                            commission=0.001, pe_low=10, pe_high=30, rebalance_days=20):
+    """
+    向量化回测 (默认入口): 持仓序列整列算好, 资金曲线一次cumprod得到
+    
+    收盘出信号、全仓进出, 持仓从下一交易日起按收盘价计收益, 换仓当日按commission扣费。
+    不模拟下单撮合/整手/滑点, 需要这些时用 run_backtest。
+    
+    参数:
+        data: 含 close / pe 列的日线, 默认用模拟数据
+    返回:
+        {'final': 最终资金, 'sharpe': 年化夏普, 'max_drawdown': 最大回撤%, 'annual_return': 年化收益%,
+         'equity': 每日资金}
+    """
+    if data is None:
+        data = make_demo_data(start_date, end_date)
+    close = data['close'].to_numpy(float)
+    pos = pe_position(data['pe'], pe_low, pe_high, rebalance_days)
+    
+    ret = np.zeros(len(close))
+    ret[1:] = pos[:-1] * (close[1:] / close[:-1] - 1)
+    ret -= np.abs(np.diff(pos, prepend=0)) * commission
+    equity = cash * np.cumprod(1 + ret)
+    
+    std = ret.std()
+    result = {
+        'final': equity[-1],
+        'sharpe': ret.mean() / std * np.sqrt(252) if std > 0 else np.nan,
+        'max_drawdown': (1 - equity / np.maximum.accumulate(equity)).max() * 100,
+        'annual_return': ((equity[-1] / cash) ** (252 / len(equity)) - 1) * 100,
+        'equity': pd.Series(equity, index=data.index),
+    }
+    
+    print(f'初始资金: {cash:.2f}')
+    print(f'最终资金: {result["final"]:.2f}')
+    print('\n========== 回测结果 ==========')
+    print(f'夏普比率: {result["sharpe"]:.2f}')
+    print(f'最大回撤: {result["max_drawdown"]:.2f}%')
+    print(f'年化收益: {result["annual_return"]:.2f}%')
+    return result
 
 
 def run_backtest(symbol='600900', start_date='20200101', end_date='20241231'):
@@ -87,6 +168,9 @@ def run_backtest(symbol='600900', start_date='20200101', end_date='20241231'):
         start_date: 开始日期
         end_date: 结束日期
     """
+    if not BACKTRADER_AVAILABLE:
+        raise ImportError('run_backtest 需要 backtrader: pip install backtrader')
+    
     # 创建Cerebro引擎
     cerebro = bt.Cerebro()
     
@@ -97,21 +181,7 @@ def run_backtest(symbol='600900', start_date='20200101', end_date='20241231'):
     try:
         # 这里需要根据实际情况获取数据
         # 示例使用模拟数据
-        dates = pd.date_range(start=start_date, end=end_date, freq='B')
-        n = len(dates)
-        
-        # 生成模拟数据（实际使用时替换为真实数据）
-        np.random.seed(42)
-        data = pd.DataFrame({
-            'datetime': dates,
-            'open': 100 + np.cumsum(np.random.randn(n) * 0.5),
-            'high': 100 + np.cumsum(np.random.randn(n) * 0.5) + 2,
-            'low': 100 + np.cumsum(np.random.randn(n) * 0.5) - 2,
-            'close': 100 + np.cumsum(np.random.randn(n) * 0.5),
-            'volume': np.random.randint(1000000, 5000000, n),
-            'pe': np.random.uniform(5, 40, n),  # 模拟PE数据
-        })
-        data.set_index('datetime', inplace=True)
+        data = make_demo_data(start_date, end_date)
         
         # 创建数据源
         class PandasData(bt.feeds.PandasData):
@@ -159,6 +229,6 @@ def run_backtest(symbol='600900', start_date='20200101', end_date='20241231'):
 
 
 if __name__ == '__main__':
-    # 运行示例回测
+    # 运行示例回测 (向量化; Backtrader 版见 run_backtest)
     print('开始PE因子回测...')
-    run_backtest()
+    run_vectorized_backtest()
@@ -8,15 +8,20 @@ VQM策略 - 高级择时轮动版 (v3.0)
 """
 
 import os
+import sys
 import pandas as pd
 import numpy as np
 from datetime import datetime
 import sqlite3
 import json
 import random
+from itertools import islice
 import warnings
 warnings.filterwarnings('ignore')
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'optimizer'))
+from _data import add_axes, panel, cs_rank, top_n, grid_map, group_pct_change, group_rolling
+
 DB_PATH = '/root/.openclaw/workspace/data/historical/historical.db'
 
 print('='*60)
@@ -65,9 +70,11 @@ df['industry'] = df['ts_code'].apply(classify_industry)
 
 # 计算技术指标
 df = df.sort_values(['ts_code', 'trade_date'])
-df['momentum_10'] = df.groupby('ts_code')['close'].pct_change(10)
-df['momentum_20'] = df.groupby('ts_code')['close'].pct_change(20)
-df['volatility'] = df.groupby('ts_code')['close'].pct_change(1).rolling(10).std().reset_index(level=0, drop=True)
+# 按股票分组的涨幅/滚动标准差都是整列一次向量计算, 不逐组分派
+df['momentum_10'] = group_pct_change(df, 'close', 10)
+df['momentum_20'] = group_pct_change(df, 'close', 20)
+df['ret1'] = group_pct_change(df, 'close', 1)
+df['volatility'] = group_rolling(df, 'ret1', 10, 'std')  # 10日收益率标准差, 窗口不跨股票
 
 # 计算市场指数 (所有股票平均)
 market = df.groupby('trade_date').agg({
@@ -79,92 +86,87 @@ market['market_trend'] = (market['close'] > market['market_ma20']).astype(int)
 
 print(f'行业分布: {df.groupby("industry")["ts_code"].nunique().to_dict()}')
 
-# 创建索引
-trading_dates = sorted(df['trade_date'].unique().tolist())
-date_data = {d: df[df['trade_date'] == d].copy() for d in trading_dates}
-market_data = market.set_index('trade_date').to_dict('index')
+# 摊成 [日期, 股票] 宽表: 回测里按 行号/股票下标 直接取值, 不再每天建一个DataFrame再过滤
+trading_dates, codes = add_axes(df)
+shape = (len(trading_dates), len(codes))
+close_mat, mom10, mom20, vol = (panel(df, c, shape) for c in ('close', 'momentum_10', 'momentum_20', 'volatility'))
+has = ~np.isnan(close_mat)  # 当天有行情
+stock_ind = np.array([classify_industry(c) for c in codes])  # 行业按代码定, 每只股票一个
+# 市场择时信号 (1=多头, 0=空头/空仓), 与日期轴逐行对齐
+signal = market['market_trend'].to_numpy()
 
 # 行业轮动信号计算
 industry_data = df.groupby(['trade_date', 'industry'])['close'].mean().reset_index()
 industry_data['ind_momentum'] = industry_data.groupby('industry')['close'].pct_change(20)
-industry_dict = {}
-for date in trading_dates:
-    ind = industry_data[industry_data['trade_date'] == date]
-    if not ind.empty:
-        ind = ind.dropna(subset=['ind_momentum'])
-        industry_dict[date] = ind.sort_values('ind_momentum', ascending=False)
+# 每天按行业动量从高到低排好的行业下标只算一次 [日期, MAX_IND], 动量为NaN的行业不入选, 不足补-1
+MAX_IND = 4  # 参数 num_ind 的上限
+ind_mom = industry_data.pivot(index='trade_date', columns='industry', values='ind_momentum').reindex(trading_dates)
+ind_names = ind_mom.columns.to_numpy()
+stock_ind_id = np.searchsorted(ind_names, stock_ind)  # 每只股票所属行业的下标
+top_ind = np.full((len(trading_dates), MAX_IND), -1)
+for di, row in enumerate(ind_mom.to_numpy()):
+    t = top_n(row, MAX_IND)
+    top_ind[di, :len(t)] = t
 
-def get_market_signal(date):
-    """市场择时信号: 1=多头, 0=空头(空仓)"""
-    m = market_data.get(date)
-    if m is None: return 1
-    return m.get('market_trend', 1)
+def get_top_industries(date_idx, n=3):
+    """获取强势行业 (行业下标)"""
+    t = top_ind[date_idx, :n]
+    return t[t >= 0]
 
-def get_top_industries(date, n=3):
-    """获取强势行业"""
-    ind = industry_dict.get(date)
-    if ind is None or ind.empty: return []
-    return ind['industry'].tolist()[:n]
+# 个股得分与参数无关, 回测前整表算一次: 每个交易日在行业内做百分位排名 (与 rank(pct=True) 相同) 后加权,
+# 科技股打8折; 再按 (日期, 行业) 选好得分前2 (同分取代码靠前的, 同 nlargest), 不足补-1
+ok = ~np.isnan(mom10) & ~np.isnan(vol)
+ind_top2 = np.full((len(trading_dates), len(ind_names), 2), -1)
+for ind, name in enumerate(ind_names):
+    cols = np.flatnonzero(stock_ind_id == ind)
+    m = ok[:, cols]
+    tech_penalty = 0.8 if name == '科技' else 1.0  # 科技股降低权重
+    score = (
+        cs_rank(np.where(m, mom10[:, cols], np.nan)) * 0.6 +
+        cs_rank(np.where(m, mom20[:, cols], np.nan)) * 0.2 -
+        cs_rank(np.where(m, vol[:, cols], np.nan)) * 0.2
+    ) * tech_penalty
+    for di, row in enumerate(score):
+        t = cols[top_n(row, 2)]
+        ind_top2[di, ind, :len(t)] = t
 
 def select_stocks(date_idx, params):
-    """选股逻辑"""
+    """选股逻辑, 返回股票下标 (强势行业依次取得分前2)"""
     if date_idx < 30: return []
     
-    date = trading_dates[date_idx]
-    
     # 市场择时: 趋势向下时空仓
-    if get_market_signal(date) == 0:
+    if signal[date_idx] == 0:
         return []
     
-    day = date_data.get(date)
-    if day is None: return []
-    
     # 获取强势行业
-    top_inds = get_top_industries(date, params['num_ind'])
-    if not top_inds: return []
-    
-    selected = []
-    for ind in top_inds:
-        ind_stocks = day[day['industry'] == ind].copy()
-        ind_stocks = ind_stocks.dropna(subset=['momentum_10', 'volatility'])
-        if ind_stocks.empty: continue
-        
-        # 科技股降低权重
-        tech_penalty = 0.8 if ind == '科技' else 1.0
-        
-        ind_stocks['score'] = (
-            ind_stocks['momentum_10'].rank(pct=True) * 0.6 +
-            ind_stocks['momentum_20'].rank(pct=True) * 0.2 -
-            ind_stocks['volatility'].rank(pct=True) * 0.2
-        ) * tech_penalty
-        
-        top = ind_stocks.nlargest(2, 'score')['ts_code'].tolist()
-        selected.extend(top)
+    top_inds = get_top_industries(date_idx, params['num_ind'])
+    if not len(top_inds): return []
     
-    return selected[:params['num_stocks']]
+    # 强势行业依次取各自的前2只 (查表)
+    selected = ind_top2[date_idx, top_inds].ravel()
+    return selected[selected >= 0][:params['num_stocks']].tolist()
 
 def run_backtest(params):
     """回测"""
     cash = 1000000.0
-    holdings = {}
-    values = []
+    holdings = {}  # 股票下标 -> 持仓
+    peak = dd = 0.0  # 净值高点和最大回撤, 每天随净值更新, 不存整条净值序列
     trades = []
     empty_periods = 0
     
     for di, date in enumerate(trading_dates):
-        day = date_data.get(date)
-        if day is None: continue
-        prices = day.set_index('ts_code')['close'].to_dict()
+        # 当天价格一行; 没有行情的股票为NaN (has[di] 为False), 比较 > 0 也为False
+        prices, listed = close_mat[di], has[di]
         
         # 检查市场信号
-        market_signal = get_market_signal(date)
+        market_signal = signal[di]
         
         # 市场信号为0时清仓
         if market_signal == 0 and holdings:
             for s in list(holdings.keys()):
-                if s in prices:
+                if listed[s]:
                     cash += holdings[s]['sh'] * prices[s]
-                    trades.append({'date': date, 'a': 'SELL', 's': s, 'r': 'market_down', 'ind': holdings[s]['ind']})
+                    trades.append({'date': date, 'a': 'SELL', 's': codes[s], 'r': 'market_down', 'ind': holdings[s]['ind']})
                     del holdings[s]
             empty_periods += 1
         
@@ -174,58 +176,59 @@ def run_backtest(params):
             if sel:
                 per = cash * params['pos'] / len(sel)
                 for s in sel:
-                    if s in prices and prices[s] > 0:
+                    if prices[s] > 0:
                         sh = int(per / prices[s] / 100) * 100
                         if sh > 0:
                             cost = sh * prices[s]
                             cash -= cost
-                            ind = day[day['ts_code']==s]['industry'].values[0] if not day[day['ts_code']==s].empty else '未知'
+                            ind = stock_ind[s]
                             holdings[s] = {'sh': sh, 'cost': cost, 'ind': ind}
-                            trades.append({'date': date, 'a': 'BUY', 's': s, 'ind': ind, 'v': cost})
+                            trades.append({'date': date, 'a': 'BUY', 's': codes[s], 'ind': ind, 'v': cost})
         
         # 止损
         for s in list(holdings.keys()):
-            if s in prices and prices[s] > 0:
+            if prices[s] > 0:
                 v = holdings[s]['sh'] * prices[s]
                 sl = params['sl'] * (1.5 if holdings[s]['ind'] == '科技' else 1.0)  # 科技股更宽松止损
                 if (v - holdings[s]['cost']) / holdings[s]['cost'] <= -sl:
                     cash += v
-                    trades.append({'date': date, 'a': 'SELL', 's': s, 'r': 'stop', 'ind': holdings[s]['ind']})
+                    trades.append({'date': date, 'a': 'SELL', 's': codes[s], 'r': 'stop', 'ind': holdings[s]['ind']})
                     del holdings[s]
         
         # 调仓
         if di % 20 == 0 and holdings and market_signal == 1:
-            new_sel = set(select_stocks(di, params))
+            new_list = select_stocks(di, params)
+            new_sel = set(new_list)
             
             for s in list(holdings.keys()):
-                if s not in new_sel and s in prices:
+                if s not in new_sel and listed[s]:
                     cash += holdings[s]['sh'] * prices[s]
-                    trades.append({'date': date, 'a': 'SELL', 's': s, 'r': 'rotate', 'ind': holdings[s]['ind']})
+                    trades.append({'date': date, 'a': 'SELL', 's': codes[s], 'r': 'rotate', 'ind': holdings[s]['ind']})
                     del holdings[s]
             
             need = params['num_stocks'] - len(holdings)
             if need > 0:
-                for s in [x for x in new_sel if x not in holdings][:need]:
-                    if s in prices and prices[s] > 0 and cash > 0:
+                # 按选股顺序补仓 (原来遍历set, 顺序随字符串哈希每次运行都不同)
+                for s in [x for x in new_list if x not in holdings][:need]:
+                    if prices[s] > 0 and cash > 0:
                         per = cash * params['pos'] / (need + 1)
                         sh = int(per / prices[s] / 100) * 100
                         if sh > 0:
                             cost = sh * prices[s]
                             cash -= cost
-                            ind = day[day['ts_code']==s]['industry'].values[0] if not day[day['ts_code']==s].empty else '未知'
+                            ind = stock_ind[s]
                             holdings[s] = {'sh': sh, 'cost': cost, 'ind': ind}
-                            trades.append({'date': date, 'a': 'BUY', 's': s, 'ind': ind, 'v': cost})
+                            trades.append({'date': date, 'a': 'BUY', 's': codes[s], 'ind': ind, 'v': cost})
         
-        v = cash + sum(holdings[s]['sh'] * prices.get(s, 0) for s in holdings)
-        values.append(v)
+        # 当天没有行情的持仓按0计
+        v = cash + sum(holdings[s]['sh'] * prices[s] for s in holdings if listed[s])
+        peak = max(peak, v)
+        dd = max(dd, (peak - v) / peak)
     
-    if len(values) < 2:
+    if len(trading_dates) < 2:
         return {'success': False, 'ret': -1, 'dd': 1, 'trades': [], 'empty': 0}
     
-    pv = np.array(values)
-    ret = (pv[-1] - 1000000) / 1000000
-    cummax = np.maximum.accumulate(pv)
-    dd = abs(np.min((pv - cummax) / cummax))
+    ret = (v - 1000000) / 1000000
     
     return {
         'success': dd <= 0.075,
@@ -233,7 +236,6 @@ def run_backtest(params):
         'dd': dd,
         'trades': trades,
         'empty': empty_periods,
-        'pv': pv
     }
 
 # 优化
@@ -242,17 +244,18 @@ all_results = []
 best_success = {'ret': -1, 'dd': 1, 'params': None}
 best_overall = {'ret': -1, 'dd': 1, 'params': None, 'trades': []}
 
+# 参数按原来的顺序先全部抽好, 各次回测互不依赖, 多进程跑 (子进程fork继承宽表);
+# 结果按抽取顺序陆续返回, 记最优/打印进度的逻辑与串行一致
+param_list = [{
+    'num_ind': random.randint(2, 4),
+    'num_stocks': random.randint(4, 8),
+    'pos': random.uniform(0.4, 0.7),
+    'sl': random.uniform(0.025, 0.05),
+} for _ in range(20 * 50)]
+runs = zip(param_list, grid_map(run_backtest, [(p,) for p in param_list]))
+
 for r in range(1, 21):
-    for _ in range(50):
-        params = {
-            'num_ind': random.randint(2, 4),
-            'num_stocks': random.randint(4, 8),
-            'pos': random.uniform(0.4, 0.7),
-            'sl': random.uniform(0.025, 0.05),
-        }
-        
-        result = run_backtest(params)
-        
+    for params, result in islice(runs, 50):
         all_results.append({
             'ret': result['ret'],
             'dd': result['dd'],
@@ -314,7 +317,7 @@ output = {
     'best_overall': {
         'return': float(best_overall['ret']),
         'drawdown': float(best_overall['dd']),
-        'success': best_overall['dd'] <= 0.075,
+        'success': bool(best_overall['dd'] <= 0.075),
         'params': best_overall.get('params')
     },
     'statistics': {
@@ -21,6 +21,15 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from tushare_data_manager import TushareDataManager
 
+# PE评分：PE 0-10=100分, 10-20=80分, 20-30=60分, 30-50=40分, 50+=20分
+PE_BINS = np.array([10, 20, 30, 50])
+PE_SCORES = np.array([100, 80, 60, 40, 20])
+
+
+def vqm_score(pe, pb):
+    """按PE分档打分, 0<PB<2 再加5分; 标量或数组均可, PE需已过滤为正数"""
+    return PE_SCORES[np.digitize(pe, PE_BINS)] + 5 * ((pb > 0) & (pb < 2))
+
 
 class VQMBacktestEngine:
     """
@@ -54,42 +63,48 @@ class VQMBacktestEngine:
         # 加载数据管理器
         self.data_manager = TushareDataManager(db_path=db_path)
         
+        # 行情 + PE/PB 一次读进内存, 按 (股票, 日期) 建索引; 回测中按股票/日期切片, 不再逐股逐月查库
+        conn = sqlite3.connect(db_path)
+        try:
+            self._cache = pd.read_sql('''
+                SELECT p.ts_code, p.trade_date, p.close, b.pe, b.pb
+                FROM daily_price p
+                LEFT JOIN daily_basic b ON p.ts_code = b.ts_code AND p.trade_date = b.trade_date
+            ''', conn).set_index(['ts_code', 'trade_date']).sort_index()
+        finally:
+            conn.close()
+        
+        # 全部交易日, 以及每月最后一个交易日 {YYYYMM: YYYYMMDD}, 一次算好
+        self._dates = np.sort(self._cache.index.get_level_values('trade_date').unique().to_numpy())
+        dates = pd.Series(self._dates)
+        self._month_end = dates.groupby(dates.str[:6]).max().to_dict()
+        
+        # 选股用的扁平数组: 股票编号 * 1e8 + 日期 作为有序键, 一次 searchsorted 定位全部股票的最新一行
+        self._codes = self._cache.index.levels[0].to_numpy()
+        sid = self._cache.index.codes[0].astype(np.int64)
+        self._key = sid * 10**8 + self._cache.index.get_level_values('trade_date').astype(np.int64)
+        self._start = np.searchsorted(sid, np.arange(len(self._codes)))
+        self._pe, self._pb, self._close = (self._cache[c].to_numpy(float) for c in ('pe', 'pb', 'close'))
+        
         print(f"✅ 回测引擎初始化完成")
         print(f"   数据库: {db_path}")
         print(f"   初始资金: ¥{initial_capital:,.0f}")
     
     def get_trading_dates(self, start_date: str, end_date: str) -> List[str]:
         """获取交易日列表"""
-        conn = sqlite3.connect(self.db_path)
-        
-        query = '''
-            SELECT DISTINCT trade_date 
-            FROM daily_price 
-            WHERE trade_date BETWEEN ? AND ?
-            ORDER BY trade_date
-        '''
-        
-        dates = pd.read_sql(query, conn, params=[start_date, end_date])
-        conn.close()
-        
-        return dates['trade_date'].tolist()
+        lo = np.searchsorted(self._dates, start_date, side='left')
+        hi = np.searchsorted(self._dates, end_date, side='right')
+        return self._dates[lo:hi].tolist()
     
     def get_last_trading_date_of_month(self, year: int, month: int) -> Optional[str]:
         """获取某月最后一个交易日"""
-        # 该月最后一天
-        if month == 12:
-            last_day = f"{year+1}0101"
-        else:
-            last_day = f"{year}{month+1:02d}01"
-        
-        first_day = f"{year}{month:02d}01"
-        
-        trading_dates = self.get_trading_dates(first_day, last_day)
-        
-        # 过滤出该月的交易日
-        month_dates = [d for d in trading_dates if d.startswith(f"{year}{month:02d}")]
-        
-        return month_dates[-1] if month_dates else None
+        return self._month_end.get(f"{year}{month:02d}")
+    
+    def _history(self, ts_code: str, trade_date: str) -> pd.DataFrame:
+        """某只股票截至 trade_date (含) 的缓存行情, 按日期升序"""
+        if ts_code not in self._cache.index.levels[0]:
+            return self._cache.iloc[:0]
+        return self._cache.loc[ts_code].loc[:trade_date]
     
     def calculate_vqm_score(self, ts_code: str, trade_date: str) -> Optional[float]:
         """
@@ -99,7 +114,7 @@ class VQMBacktestEngine:
         PE越低越好，ROE越高越好
         """
         # 获取当日数据
-        df = self.data_manager.get_daily_data(ts_code, end_date=trade_date)
+        df = self._history(ts_code, trade_date)
         
         if df.empty or len(df) < 20:
             return None
@@ -112,28 +127,9 @@ class VQMBacktestEngine:
         if pd.isna(pe) or pe <= 0:
             return None
         
-        # 简化PE评分：PE 0-10=100分, 10-20=80分, 20-30=60分, 30-50=40分, 50+=20分
-        if pe < 10:
-            pe_score = 100
-        elif pe < 20:
-            pe_score = 80
-        elif pe < 30:
-            pe_score = 60
-        elif pe < 50:
-            pe_score = 40
-        else:
-            pe_score = 20
-        
-        # PB作为辅助指标
-        pb = latest.get('pb', 0)
-        if pb > 0 and pb < 2:
-            pe_score += 5  # 低PB加分
-        
-        # 综合评分（简化版，仅用PE+PB）
+        # 综合评分（简化版，仅用PE+PB, PB作为辅助指标）
         # 完整版需要财务报表数据计算ROE
-        vqm_score = pe_score
-        
-        return vqm_score
+        return int(vqm_score(pe, latest.get('pb', 0)))
     
     def select_stocks(self, trade_date: str, top_n: int = 10) -> List[Dict]:
         """
@@ -144,33 +140,31 @@ class VQMBacktestEngine:
         """
         # 获取所有股票
         stocks = self.data_manager.get_stock_basic()
-        
-        scores = []
-        
-        for _, row in stocks.iterrows():
-            ts_code = row['ts_code']
-            name = row['name']
-            
-            score = self.calculate_vqm_score(ts_code, trade_date)
-            
-            if score:
-                # 获取当日PE
-                df = self.data_manager.get_daily_data(ts_code, end_date=trade_date)
-                if not df.empty:
-                    latest = df.iloc[-1]
-                    scores.append({
-                        'ts_code': ts_code,
-                        'name': name,
-                        'score': score,
-                        'pe': latest.get('pe', 0),
-                        'pb': latest.get('pb', 0),
-                        'close': latest.get('close', 0)
-                    })
-        
-        # 按评分排序
-        scores.sort(key=lambda x: x['score'], reverse=True)
-        
-        return scores[:top_n]
+        codes = stocks['ts_code'].to_numpy()
+        
+        # 每只股票截至当日的最新一行及历史行数 (与 calculate_vqm_score 条件相同: 至少20行, PE为正)
+        sid = np.searchsorted(self._codes, codes).clip(max=len(self._codes) - 1)
+        ok = self._codes[sid] == codes
+        pos = np.searchsorted(self._key, sid * 10**8 + int(trade_date), side='right') - 1
+        ok &= pos - self._start[sid] + 1 >= 20
+        pos = np.where(ok, pos, 0)
+        pe, pb, close = self._pe[pos], self._pb[pos], self._close[pos]
+        ok &= pe > 0
+        
+        # 全部股票一次打分; 稳定排序, 同分按股票列表顺序
+        score = vqm_score(pe, pb)
+        idx = np.flatnonzero(ok)
+        idx = idx[np.argsort(-score[idx], kind='stable')[:top_n]]
+        
+        names = stocks['name'].to_numpy()
+        return [{
+            'ts_code': codes[i],
+            'name': names[i],
+            'score': int(score[i]),
+            'pe': pe[i],
+            'pb': pb[i],
+            'close': close[i]
+        } for i in idx]
     
     def run_backtest(self, start_date: str = '20180101', end_date: str = '20251231') -> Dict:
         """